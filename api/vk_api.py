@@ -3,19 +3,342 @@ import asyncio
 import json
 import logging
 import aiohttp
+import contextlib
+import contextvars
+import heapq
+import itertools
 import os
+import time
+import urllib.parse
+import uuid
+from utils import metrics
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_BACKGROUND = 2
+RATE_LIMITERS = dict()
+MAX_IMAGE_SIZE = 50 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DEADLINE = contextvars.ContextVar('vk_deadline', default=None)
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    # every vk call made inside the block (and in tasks created from it) gives up after `seconds`
+    new_deadline = time.monotonic() + seconds
+    current = DEADLINE.get()
+    token = DEADLINE.set(min(current, new_deadline) if current else new_deadline)
+    try:
+        yield
+    finally:
+        DEADLINE.reset(token)
+
+
+def get_time_left():
+    current = DEADLINE.get()
+    if current is None:
+        return None
+    return current - time.monotonic()
+
+
+def parse_retry_after(value):
+    try:
+        return max(0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    # 1 - unknown error, 6 - too many requests, 10 - internal server error
+    RETRY_ERROR_CODES = (1, 6, 10)
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, max_attempts=5, base_delay=0.5, max_delay=30,
+                 retry_codes=RETRY_ERROR_CODES, retry_statuses=RETRY_STATUSES):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_codes = retry_codes
+        self.retry_statuses = retry_statuses
+
+    def need_retry(self, result):
+        return result.get('error', {}).get('error_code') in self.retry_codes
+
+    def delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return retry_after
+        # exponential backoff with full jitter
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class RateLimiter:
+    def __init__(self, rate=20, burst=None):
+        self.rate = rate
+        self.burst = burst if burst else max(1, rate // 5)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.waiters = []
+        self.counter = itertools.count()
+        self.dispatcher = None
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def queue_size(self):
+        return len(self.waiters)
+
+    async def acquire(self, priority=PRIORITY_DEFAULT):
+        self.refill()
+        if not self.waiters and self.tokens >= 1:
+            self.tokens -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.counter), future))
+        if not self.dispatcher or self.dispatcher.done():
+            self.dispatcher = asyncio.create_task(self.dispatch())
+        await future
+
+    async def dispatch(self):
+        while self.waiters:
+            self.refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                continue
+            _, _, future = heapq.heappop(self.waiters)
+            if future.done():  # caller was cancelled while waiting
+                continue
+            self.tokens -= 1
+            future.set_result(None)
+
+    def throttle(self):
+        # vk answered "too many requests": drop the saved burst so every lane slows down
+        self.refill()
+        self.tokens = min(self.tokens, 0)
+
+
+def get_rate_limiter(token, rate):
+    if token not in RATE_LIMITERS:
+        RATE_LIMITERS[token] = RateLimiter(rate)
+    return RATE_LIMITERS[token]
+
+
+class ExecuteBatcher:
+    MAX_CALLS = 25
+
+    def __init__(self, api, window=0.02):
+        self.api = api
+        self.window = window
+        self.pending = []
+        self.timer = None
+        self.tasks = set()
+
+    async def call(self, method, parameters=None, priority=PRIORITY_DEFAULT):
+        params = {k: v for k, v in (parameters or {}).items() if k not in ('access_token', 'v')}
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((method, params, priority, future, DEADLINE.get()))
+        if len(self.pending) >= self.MAX_CALLS:
+            self.flush()
+        elif not self.timer:
+            self.timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        calls, self.pending = self.pending[:self.MAX_CALLS], self.pending[self.MAX_CALLS:]
+        if self.pending:
+            self.timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+        if calls:
+            task = asyncio.create_task(self.send(calls))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def send(self, calls):
+        calls = [c for c in calls if not c[3].done()]
+        if not calls:
+            return
+        priority = min(c[2] for c in calls)
+        deadlines = [c[4] for c in calls]
+        # runs in its own task, so this only affects the shared request
+        DEADLINE.set(None if None in deadlines else max(deadlines))
+        calls = [c[:4] for c in calls]
+        try:
+            if len(calls) == 1:
+                method, params, _, future = calls[0]
+                result = await self.api.request_get(method, params, priority=priority, retries=False)
+                if not future.done():
+                    future.set_result(result)
+                return
+            code = 'return [' + ','.join(f'API.{method}({json.dumps(params, ensure_ascii=False)})'
+                                         for method, params, _, _ in calls) + '];'
+            result = await self.api.request_get('execute', {'code': code}, priority=priority, retries=False)
+        except Exception as error_msg:
+            for _, _, _, future in calls:
+                if not future.done():
+                    future.set_exception(error_msg)
+            return
+
+        responses = result.get('response')
+        if not isinstance(responses, list):
+            # the whole execute failed, every caller gets the same answer
+            for _, _, _, future in calls:
+                if not future.done():
+                    future.set_result(result)
+            return
+        # failed sub-calls return false, their errors are listed in order in execute_errors
+        errors = iter(result.get('execute_errors', []))
+        for num, (method, _, _, future) in enumerate(calls):
+            if num >= len(responses):
+                answer = {'error': {'error_code': 0, 'error_msg': f'no execute result for {method}'}}
+            elif responses[num] is False:
+                answer = {'error': next(errors, {'error_code': 0, 'error_msg': f'{method} failed in execute'})}
+            else:
+                answer = {'response': responses[num]}
+            error_code = answer.get('error', {}).get('error_code', 0)
+            if error_code == 6:  # too many requests
+                self.api.limiter.throttle()
+            metrics.VK_CALLS.inc(method=method, error=error_code)
+            if not future.done():
+                future.set_result(answer)
+
+
+def get_domain(url):
+    # images come from many sunX-Y.userapi.com hosts, the limit is per domain
+    host = urllib.parse.urlsplit(url).hostname or ''
+    labels = host.split('.')
+    if len(labels) <= 2 or labels[-1].isdigit() or ':' in host:
+        return host
+    return '.'.join(labels[-2:])
+
+
+class UploadExecutor:
+    # limits image uploads in flight and parallel downloads from one domain
+    def __init__(self, max_uploads=4, max_per_host=2):
+        self.configure(max_uploads, max_per_host)
+        self.queued = 0
+        self.active = 0
+        self.done = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.downloaded = 0
+
+    def configure(self, max_uploads, max_per_host):
+        self.max_uploads = max_uploads
+        self.max_per_host = max_per_host
+        self.uploads = asyncio.Semaphore(max_uploads)
+        self.hosts = dict()
+
+    def host_limit(self, url):
+        domain = get_domain(url)
+        if domain not in self.hosts:
+            self.hosts[domain] = asyncio.Semaphore(self.max_per_host)
+        return self.hosts[domain]
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        self.queued += 1
+        try:
+            await self.uploads.acquire()
+        finally:
+            self.queued -= 1
+        self.active += 1
+        try:
+            yield
+        except asyncio.CancelledError:
+            # the user's request was abandoned, don't keep the slot busy
+            self.cancelled += 1
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.active -= 1
+            self.uploads.release()
+
+    async def gather(self, *aws):
+        # when one upload fails or the caller gives up the rest are cancelled
+        tasks = [asyncio.ensure_future(aw) for aw in aws]
+        try:
+            return await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def stats(self):
+        return {
+            'queued': self.queued,
+            'active': self.active,
+            'done': self.done,
+            'failed': self.failed,
+            'cancelled': self.cancelled,
+            'downloaded': self.downloaded,
+        }
+
+
+UPLOADS = UploadExecutor()
 
 
 class VkApi:
-    def __init__(self, key, version):
+    def __init__(self, key, version, connections_limit=100, connections_per_host=30,
+                 keepalive_timeout=30, dns_cache_ttl=300, request_timeout=60, rate_limit=20,
+                 batch_window=0.02, retry_policy=None):
         self.token = key
         self.v = version
+        self.retry_policy = retry_policy if retry_policy else RetryPolicy()
+        self.limiter = get_rate_limiter(key, rate_limit)
+        self.batcher = ExecuteBatcher(self, batch_window)
         self.vk_url = "https://api.vk.com/method/"
+        self.connections_limit = connections_limit
+        self.connections_per_host = connections_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.request_timeout = request_timeout
+        self.session = None
+        self.own_session = False
+
+    async def start(self, session=None):
+        if self.session and not self.session.closed:
+            return self.session
+        if session:
+            # share an already opened pool (e.g. with another token)
+            self.session = session
+            self.own_session = False
+            return self.session
+        connector = aiohttp.TCPConnector(limit=self.connections_limit,
+                                         limit_per_host=self.connections_per_host,
+                                         keepalive_timeout=self.keepalive_timeout,
+                                         ttl_dns_cache=self.dns_cache_ttl,
+                                         use_dns_cache=True)
+        self.session = aiohttp.ClientSession(connector=connector,
+                                             timeout=aiohttp.ClientTimeout(total=self.request_timeout))
+        self.own_session = True
+        return self.session
 
-    async def request_get(self, method, parameters=None, session=None):
-        if not session:
+    async def close(self):
+        if self.session and self.own_session and not self.session.closed:
+            await self.session.close()
+        self.session = None
+        self.own_session = False
+
+    @contextlib.asynccontextmanager
+    async def get_session(self):
+        if self.session and not self.session.closed:
+            yield self.session
+        else:
+            # pool is not started yet (or already closed), fall back to a one-off session
             async with aiohttp.ClientSession() as session:
-                return await self.request_get(method, parameters, session)
+                yield session
+
+    async def request_get(self, method, parameters=None, session=None, priority=PRIORITY_DEFAULT,
+                          batch=False, retries=True):
+        # batched calls are retried by each caller, the batcher sends them with retries=False
+        if not session and not batch:
+            async with self.get_session() as session:
+                return await self.request_get(method, parameters, session, priority, retries=retries)
 
         if not parameters:
             parameters = {'access_token': self.token, 'v': self.v}
@@ -24,26 +347,56 @@ class VkApi:
         if 'v' not in parameters:
             parameters.update({'v': self.v})
 
+        attempt = 0
+        while True:
+            if batch and not session:
+                result = await self.batcher.call(method, parameters, priority)
+                retry, retry_after = self.retry_policy.need_retry(result), None
+            else:
+                result, retry, retry_after = await self.request_once(method, parameters, session, priority)
+            attempt += 1
+            if not retry or not retries:
+                return result
+            if attempt >= self.retry_policy.max_attempts:
+                logging.error(f'{method}: giving up after {attempt} attempts')
+                return result
+            delay = self.retry_policy.delay(attempt, retry_after)
+            time_left = get_time_left()
+            if time_left is not None and delay >= time_left:
+                logging.error(f'{method}: deadline exceeded after {attempt} attempts')
+                return result
+            await asyncio.sleep(delay)
+
+    async def request_once(self, method, parameters, session, priority):
+        time_left = get_time_left()
+        if time_left is not None and time_left <= 0:
+            return {}, False, None
+        result, retry, retry_after = await self.send_request(method, parameters, session, priority, time_left)
+        metrics.VK_CALLS.inc(method=method, error=result.get('error', {}).get('error_code', 0) if result else -1)
+        return result, retry, retry_after
+
+    async def send_request(self, method, parameters, session, priority, time_left):
         try:
-            async with session.post(self.vk_url + method, data=parameters) as response:
-                if response.status == 200:
-                    request = await response.json()
-                    if request.get('error', {'error_code': 0})['error_code'] == 6:  # too many requests
-                        return self.request_get(method, parameters)
-                    return request
-                else:
-                    logging.error(f'request.status_code = {response.status}')
-                    await asyncio.sleep(5)
-                    return self.request_get(method, parameters, session)
-
-        except aiohttp.ClientConnectionError as error_msg:
-            logging.error(f'connection problems {error_msg}')
-            await asyncio.sleep(5)
-            return self.request_get(method, parameters, session)
+            await asyncio.wait_for(self.limiter.acquire(priority), time_left)
+            timeout = {'timeout': aiohttp.ClientTimeout(total=time_left)} if time_left is not None else {}
+            async with session.post(self.vk_url + method, data=parameters, **timeout) as response:
+                if response.status != 200:
+                    logging.error(f'{method}: request.status_code = {response.status}')
+                    retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                    return {}, response.status in self.retry_policy.retry_statuses, retry_after
+                request = await response.json()
+
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as error_msg:
+            logging.error(f'{method}: connection problems {error_msg!r}')
+            return {}, True, None
 
         except Exception as error_msg:
-            logging.error(f'{error_msg}')
-            return {}
+            logging.error(f'{method}: {error_msg}')
+            return {}, False, None
+
+        if request.get('error', {}).get('error_code') == 6:  # too many requests
+            self.limiter.throttle()
+        return request, self.retry_policy.need_retry(request), None
 
     async def msg_get(self, msg_id):
         msg = await self.request_get('messages.getById', {'message_ids': msg_id})
@@ -54,11 +407,11 @@ class VkApi:
             logging.error(f'send message {msg}')
             return None
 
-    async def msg_send(self, payload):
-        payload['random_id'] = payload.get('random_id', random.randint(0, 2 ** 64))
+    async def msg_send(self, payload, priority=PRIORITY_INTERACTIVE):
+        payload['random_id'] = payload.get('random_id', random.randint(0, 2 ** 31 - 1))
         if type(payload.get('attachment', '')) != str:
             payload['attachment'] = ','.join(payload['attachment'])
-        msg = await self.request_get('messages.send', payload)
+        msg = await self.request_get('messages.send', payload, priority=priority, batch=True)
         logging.debug(f'send message {msg}')
         if 'response' in msg:
             return msg['response']
@@ -66,8 +419,9 @@ class VkApi:
             logging.error(f'send message {msg}')
             return None
 
-    async def msg_read(self, peer_id):
-        msg = await self.request_get('messages.markAsRead', {'peer_id': peer_id})
+    async def msg_read(self, peer_id, priority=PRIORITY_INTERACTIVE):
+        msg = await self.request_get('messages.markAsRead', {'peer_id': peer_id},
+                                     priority=priority, batch=True)
         logging.debug(f'read chat {msg}')
         if 'response' in msg:
             return msg['response']
@@ -75,46 +429,77 @@ class VkApi:
             logging.error(f'send message {msg}')
             return None
 
+    async def download_image(self, image_url, session, max_size=MAX_IMAGE_SIZE):
+        # reads the image into one growing buffer, nothing is written to disk
+        async with UPLOADS.host_limit(image_url), session.get(image_url) as resp:
+            if resp.status != 200:
+                logging.error(f'download file: {resp.status}')
+                return None, None
+            if resp.content_length and resp.content_length > max_size:
+                logging.error(f'download file: {image_url} is too big ({resp.content_length} bytes)')
+                return None, None
+            image = bytearray()
+            async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                image += chunk
+                UPLOADS.downloaded += len(chunk)
+                if len(image) > max_size:
+                    logging.error(f'download file: {image_url} is bigger than {max_size} bytes')
+                    return None, None
+            return image, resp.content_type
+
     async def upload_image(self, image_url, peer_id=0, default_image='',
                            group_id=None,
                            server_method='photos.getMessagesUploadServer',
-                           save_method='photos.saveMessagesPhoto'):
-        dir_path = os.path.abspath('img')
-        if not os.path.exists(dir_path):
-            os.makedirs(dir_path)
-        async with aiohttp.ClientSession() as session:
+                           save_method='photos.saveMessagesPhoto',
+                           priority=PRIORITY_DEFAULT):
+        async with UPLOADS.slot():
+            vk_image = await self.upload_photo(image_url, peer_id, group_id,
+                                               server_method, save_method, priority)
+        if not vk_image:
+            UPLOADS.failed += 1
+            return default_image
+        UPLOADS.done += 1
+        if vk_image.get('access_key'):
+            return f"photo{vk_image['owner_id']}_{vk_image['id']}_{vk_image['access_key']}"
+        return f"photo{vk_image['owner_id']}_{vk_image['id']}"
+
+    async def upload_photo(self, image_url, peer_id, group_id, server_method, save_method, priority):
+        async with self.get_session() as session:
             upload_params = {}
             if peer_id:
                 upload_params.update({'peer_id': peer_id})
             if group_id:
                 upload_params.update({'group_id': group_id})
-            upload_server = await self.request_get(server_method,
-                                                   upload_params, session)
+            upload_server = asyncio.create_task(self.request_get(server_method,
+                                                                 upload_params, session, priority))
+            try:
+                image, content_type = await self.download_image(image_url, session)
+            except Exception as error_msg:
+                logging.error(f'download file: {error_msg!r}')
+                image, content_type = None, None
+            if image is None:
+                upload_server.cancel()
+                return None
+            upload_server = await upload_server
             if 'response' not in upload_server:
                 logging.error(f'upload_server: {upload_server}')
-                return default_image
+                return None
             upload_url = upload_server['response']['upload_url']
-            filename = os.path.join(dir_path, image_url.split('/')[-1])
-
-            async with session.get(image_url) as resp:
-                if resp.status == 200:
-                    image = await resp.read()
-                    with open(filename, "wb") as f:
-                        f.write(image)
-                else:
-                    logging.error(f'download file: {resp.status}')
-                    return default_image
-            file = {'photo': open(filename, 'rb')}
-            async with session.post(upload_url, data=file) as upload_image:
-                if resp.status == 200:
+
+            # unique name, concurrent uploads of files with the same basename must not collide
+            extension = os.path.splitext(image_url.split('?')[0])[1] or '.jpg'
+            form = aiohttp.FormData()
+            form.add_field('photo', image, filename=uuid.uuid4().hex + extension,
+                           content_type=content_type or 'image/jpeg')
+            try:
+                async with session.post(upload_url, data=form) as upload_image:
+                    if upload_image.status != 200:
+                        logging.error(f'upload file: {upload_image.status}')
+                        return None
                     upload_response = json.loads(await upload_image.text())
-                else:
-                    logging.error(f'upload file: {resp.status}')
-                    if os.path.exists(filename):
-                        os.remove(filename)
-                    return default_image
-            if os.path.exists(filename):
-                os.remove(filename)
+            except Exception as error_msg:
+                logging.error(f'upload file: {error_msg!r}')
+                return None
 
             image_params = {
                 'photo': upload_response['photo'],
@@ -123,13 +508,11 @@ class VkApi:
             }
             if group_id:
                 image_params.update({'group_id': group_id})
-            save_image = await self.request_get(save_method, image_params, session)
+            save_image = await self.request_get(save_method, image_params, session, priority)
             if 'response' not in save_image:
                 logging.error(f'save_image: {save_image}')
-                return default_image
-            # print('save_image', save_image)
-            vk_image = save_image['response'][0]
-            return f"photo{vk_image['owner_id']}_{vk_image['id']}_{vk_image['access_key']}"
+                return None
+            return save_image['response'][0]
 
     async def get_groups_info(self, group_ids, fields=''):
         msg = await self.request_get('groups.getById', {'group_ids': group_ids,
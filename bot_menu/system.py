@@ -3,16 +3,78 @@ import json
 import asyncio
 import time
 import random
+import heapq
 import peewee
 from main import vk, CONF
 from database import db_api
 from api import vk_api
+from utils import phash
+from utils.navigation import NavigationStore
+from utils.render import RenderCache
+from utils.workers import PeerWorkers
 BTN_PER_PAGE = 12
 TIME_BETWEEN_POSTS_FROM_GROUP = 3 * 24 * 60 * 60
 MAX_GROUP_LIKES = 75
 MAX_GROUP_SUBS = 1500
 MAX_POSTPONED_POSTS = 20
-LAST_MESSAGES = dict()
+HOUR = 60 * 60
+DAY = 24 * HOUR
+POST_TIMES = [1 * HOUR, 4 * HOUR, 7 * HOUR, 10 * HOUR, 13 * HOUR, 15 * HOUR, 17 * HOUR, 19 * HOUR, 21 * HOUR, 23 * HOUR]
+ROUTE_TIMEOUT = 30
+# part of the reply deadline kept for sending the answer, the timeout reply included
+REPLY_SEND_TIME = CONF.getint('VK', 'reply_send_time', fallback=5)
+NOTIFY_INTERVAL = 60 * 60
+NOTIFY_CHUNK = CONF.getint('VK', 'notify_chunk', fallback=vk_api.ExecuteBatcher.MAX_CALLS)
+HASH_MIN_SIZE = 100
+HASH_DISTANCE = CONF.getint('VK', 'phash_distance', fallback=6)
+HASH_INDEX = phash.HashIndex()
+NAVIGATION = NavigationStore(max_size=CONF.getint('VK', 'nav_cache_size', fallback=50000),
+                             max_depth=CONF.getint('VK', 'nav_depth', fallback=20),
+                             refresh=CONF.getint('VK', 'nav_refresh', fallback=24 * 60 * 60))
+RENDER_CACHE = RenderCache(max_size=CONF.getint('VK', 'render_cache_size', fallback=10000),
+                           ttl=CONF.getint('VK', 'render_ttl', fallback=10 * 60))
+db_api.WRITE_LISTENERS.append(RENDER_CACHE.invalidate)
+ROUTES = dict()
+
+
+class Route:
+    def __init__(self, mid, handler, admin_only=False, timeout=ROUTE_TIMEOUT, keys=(), cache=None, per_user=True):
+        self.mid = mid
+        self.handler = handler
+        self.admin_only = admin_only
+        self.timeout = timeout
+        self.keys = keys
+        self.cache = cache
+        self.per_user = per_user
+        self.calls = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.total_time = 0
+        self.max_time = 0
+
+    def record(self, duration):
+        self.calls += 1
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'timeouts': self.timeouts,
+            'errors': self.errors,
+            'mean_time': self.total_time / self.calls if self.calls else 0,
+            'max_time': self.max_time,
+        }
+
+
+def route(mid=None, admin_only=False, timeout=ROUTE_TIMEOUT, keys=(), cache=None, per_user=True):
+    # registers a menu handler, `mid` defaults to the handler name.
+    # `cache` lists the tables the rendered menu depends on, None disables caching
+    def decorator(handler):
+        name = mid if mid else handler.__name__
+        ROUTES[name] = Route(name, handler, admin_only, timeout, keys, cache, per_user)
+        return handler
+    return decorator
 
 
 class Button:
@@ -31,15 +93,21 @@ class Keyboard:
         self.default_payload = []
         if default_payload:
             self.default_payload = default_payload if save_menu else default_payload[:-1]
+        # what the keyboard was built from, None when the buttons were passed in ready
+        self.parts = None if buttons else []
 
     def add_button(self, label, payload, color='default', row=-1):
         new_payload = self.default_payload + [payload] if payload else self.default_payload
         new_button = Button(label, new_payload, color)
+        if self.parts is not None:
+            self.parts.append((label, payload, color, row))
         if row >= len(self.buttons):
             self.buttons.extend([[] for _ in range(row - len(self.buttons) + 1)])
         self.buttons[row].append(new_button)
 
     def navigation_buttons(self, ):
+        if self.parts is not None:
+            self.parts.append('navigation')
         self.buttons.extend([[] for _ in range(10 - len(self.buttons) + 1)])
         if len(self.default_payload) > 1:
             if self.save_menu:
@@ -48,7 +116,31 @@ class Keyboard:
                 self.buttons[10] = [Button('назад', self.default_payload)]
         self.buttons[10].append(Button('домой', self.default_payload + [{'mid': 'main'}]))
 
+    def cache_key(self):
+        if self.parts is None:
+            return None
+        # save_menu picks the target of the back button
+        return json.dumps([self.inline, self.one_time, self.save_menu, self.default_payload, self.parts],
+                          ensure_ascii=False)
+
+    def add_parts(self, parts):
+        # rebuilds a keyboard from the parts of another one, on this keyboard's payload stack
+        for part in parts:
+            if part == 'navigation':
+                self.navigation_buttons()
+            else:
+                self.add_button(*part)
+
     def get_vk_keyboard(self):
+        key = self.cache_key()
+        keyboard = RENDER_CACHE.get(('keyboard', key)) if key else None
+        if keyboard is None:
+            keyboard = self.render()
+            if key:
+                RENDER_CACHE.put(('keyboard', key), keyboard)
+        return keyboard
+
+    def render(self):
         buttons = []
         for button_row in self.buttons:
             if button_row:
@@ -58,10 +150,7 @@ class Keyboard:
                         buttons.append([])
                     elif not self.inline and len(buttons[-1]) >= 4:
                         buttons.append([])
-                    btn_payload = json.dumps(button.payload, ensure_ascii=False)
-                    while len(btn_payload) > 255:
-                        button.payload.pop(0)
-                        btn_payload = json.dumps(button.payload, ensure_ascii=False)
+                    btn_payload = json.dumps({'s': NAVIGATION.put(button.payload)})
                     new_button = {
                         'action': {
                             'type': 'text',
@@ -88,40 +177,43 @@ class BotMessage:
         self.attachments = attachments if attachments else []
         self.forward_messages = forward_messages
         self.keyboard = keyboard if keyboard else Keyboard(default_payload=default_payload, save_menu=save_menu)
+        self.rendered = None
 
     def convert_to_vk(self):
-        return {
-            'peer_id': self.peer_id,
-            'message': self.text,
-            'attachment': ','.join(self.attachments),
-            'keyboard': self.keyboard.get_vk_keyboard(),
-            'forward_messages': self.forward_messages
-        }
+        # rendered once, every call gets its own copy since sending modifies it
+        if self.rendered is None:
+            self.rendered = {
+                'peer_id': self.peer_id,
+                'message': self.text,
+                'attachment': ','.join(self.attachments),
+                'keyboard': self.keyboard.get_vk_keyboard(),
+                'forward_messages': self.forward_messages
+            }
+        return dict(self.rendered, peer_id=self.peer_id)
 
 
 class AdminFunctions:
-    async def change_tag_list(self, msg):
+    @route(admin_only=True)
+    @db_api.threaded
+    def change_tag_list(self, msg):
         bot_message = BotMessage(
             peer_id=msg.peer_id,
             text="Список тегов",
             default_payload=msg.payload
         )
-        offset = msg.payload[-1].get('offset', 0)
-        tags = db_api.Tag.select().limit(BTN_PER_PAGE).order_by(db_api.Tag.title).offset(offset * BTN_PER_PAGE)
-        tags_count = db_api.Tag.select().count()
+        tags, prev_page, next_page = db_api.get_page(db_api.Tag.select(),
+                                                     (db_api.Tag.title, db_api.Tag.id),
+                                                     **get_cursor(msg.payload[-1]), limit=BTN_PER_PAGE)
         for t in tags:
             bot_message.keyboard.add_button(t.title, {'mid': 'change_tag', 'tid': t.id})
         bot_message.keyboard.add_button('Создать новый тег', {'mid': 'change_tag', 'new': True}, row=5)
-        bot_message.keyboard.add_button('<-', {'mid': 'change_tag_list',
-                                               'offset': max(offset - 1, 0)},
-                                        row=9)
-        bot_message.keyboard.add_button('->', {'mid': 'change_tag_list',
-                                               'offset': min(offset + 1, tags_count // BTN_PER_PAGE)},
-                                        row=9)
+        page_buttons(bot_message.keyboard, {'mid': 'change_tag_list'}, prev_page, next_page)
         bot_message.keyboard.navigation_buttons()
         return bot_message
 
-    async def change_tag(self, msg):
+    @route(admin_only=True)
+    @db_api.threaded
+    def change_tag(self, msg):
         if msg.payload[-1].get('new'):
             tag = db_api.Tag.create()
         else:
@@ -166,7 +258,9 @@ class AdminFunctions:
         bot_message.keyboard.navigation_buttons()
         return bot_message
 
-    async def delete_tag(self, msg):
+    @route(admin_only=True, keys=('tid',))
+    @db_api.threaded
+    def delete_tag(self, msg):
         tag_id = msg.payload[-1].get('tid')
         if tag_id:
             db_api.Tag.delete().where(db_api.Tag.id == tag_id).execute()
@@ -179,7 +273,9 @@ class AdminFunctions:
             bot_message.keyboard.navigation_buttons()
         return bot_message
 
-    async def confirm_group_list(self, msg):
+    @route(admin_only=True)
+    @db_api.threaded
+    def confirm_group_list(self, msg):
         bot_message = BotMessage(
             peer_id=msg.peer_id,
             text="Список добавленных пользователями групп для подтверждения.",
@@ -194,7 +290,9 @@ class AdminFunctions:
         bot_message.keyboard.navigation_buttons()
         return bot_message
 
-    async def confirm_group(self, msg):
+    @route(admin_only=True, keys=('gid',))
+    @db_api.threaded
+    def confirm_group(self, msg):
         group_id = msg.payload[-1].get('gid')
         group = db_api.Group.get_or_none(id=group_id)
         group_link = get_group_link(group.id, group.name)
@@ -280,7 +378,9 @@ class AdminFunctions:
 
         return bot_message
 
-    async def confirm_art_list(self, msg):
+    @route(admin_only=True)
+    @db_api.threaded
+    def confirm_art_list(self, msg):
         bot_message = BotMessage(
             peer_id=msg.peer_id,
             text="Список добавленных пользователями артов для подтверждения.",
@@ -293,115 +393,22 @@ class AdminFunctions:
         bot_message.keyboard.navigation_buttons()
         return bot_message
 
+    @route(admin_only=True, keys=('aid',))
     async def confirm_art(self, msg):
-        art = db_api.Art.get_or_none(id=msg.payload[-1].get('aid'))
-        group_link = get_group_link(art.from_group.id, art.from_group.name)
-        user_link = f"@id{art.add_by.id} ({art.add_by.name})"
-        selected_tags = db_api.ArtTag.select().where(db_api.ArtTag.art == art)
-        tag_list = [f"#{t.tag.title.replace(' ', '_')}" for t in selected_tags]
-        tag_list = '\n'.join(sorted(tag_list))
-
-        art_accept = msg.payload[-1].get('accept')
-        bot_message = BotMessage(
-            peer_id=msg.peer_id,
-            text=f"{tag_list}\n\n"
-                 f"Группа {group_link}\n"
-                 f"Пост: vk.com/{art.source}\n"
-                 f"Добавил(а) {user_link}",
-            default_payload=msg.payload,
-            save_menu=not art_accept,
-            attachments=[art.vk_id],
-            forward_messages=art.message_id
-        )
-
-        if art_accept == 1:
-            art.accepted = 1
-            art.save()
-
-            group_arts = db_api.Art.select()\
-                .where((db_api.Art.from_group == art.from_group) &
-                       (db_api.Art.accepted > 0))\
-                .order_by(db_api.Art.add_time.desc())\
-                .limit(10)
-            message_ids = [str(art.message_id) for art in group_arts]
+        if msg.payload[-1].get('accept') == 1:
+            message_ids = await db_api.run(accept_art, msg.payload[-1].get('aid'))
             messages = await vk.request_get('messages.getById',
                                             {'message_ids': ','.join(message_ids)})
-            likes = list()
-            views = list()
-            for message in messages['response']['items']:
-                for attachment in message.get('attachments', []):
-                    if attachment['type'] == 'wall':
-                        l = attachment['wall'].get('likes', {}).get('count', 0)
-                        if l:
-                            likes.append(l)
-                        v = attachment['wall'].get('views', {}).get('count', 0)
-                        if v:
-                            views.append(v)
-            if len(likes):
-                art.from_group.likes = sum(likes)/len(likes)
-            if len(views):
-                art.from_group.views = sum(views)/len(views)
-            art.from_group.last_post = art.add_time
-            art.from_group.save()
-            bot_message.keyboard.add_button('Отклонить',
-                                            {'mid': 'confirm_art',
-                                             'aid': art.id,
-                                             'accept': -1},
-                                            color='negative')
-            bot_message.keyboard.add_button('К списку',
-                                            {'mid': 'confirm_art_list'},
-                                            row=2)
-            arts = list(db_api.Art.select().where(db_api.Art.accepted == 0).limit(1))
-            if arts:
-                bot_message.keyboard.add_button('Следующий',
-                                                {'mid': 'confirm_art',
-                                                 'aid': arts[0].id},
-                                                row=2)
-
-        elif art_accept == -1:
-            last_art = db_api.Art.select()\
-                .where(db_api.Art.accepted == 2)\
-                .order_by(db_api.Art.add_time.desc())\
-                .limit(1)
-            last_art_time = list(last_art)[0].add_time if list(last_art) else 0
-            art.accepted = -1
-            art.from_group.last_post = last_art_time
-            art.from_group.save()
-            art.save()
-            bot_message.keyboard.add_button('Одобрить',
-                                            {'mid': 'confirm_art',
-                                             'aid': art.id,
-                                             'accept': 1},
-                                            color='positive')
-            bot_message.keyboard.add_button('К списку',
-                                            {'mid': 'confirm_art_list'},
-                                            row=2)
-            arts = list(db_api.Art.select().where(db_api.Art.accepted == 0).limit(1))
-            if arts:
-                bot_message.keyboard.add_button('Следующий',
-                                                {'mid': 'confirm_art',
-                                                 'aid': arts[0].id},
-                                                row=2)
-        else:
-            bot_message.keyboard.add_button('Одобрить',
-                                            {'mid': 'confirm_art',
-                                             'aid': art.id,
-                                             'accept': 1},
-                                            color='positive')
-            bot_message.keyboard.add_button('Отклонить',
-                                            {'mid': 'confirm_art',
-                                             'aid': art.id,
-                                             'accept': -1},
-                                            color='negative')
-
-            bot_message.keyboard.add_button('Теги', {'mid': 'art_tags',
-                                                     'aid': art.id}, row=2)
-        bot_message.keyboard.navigation_buttons()
-        return bot_message
+            await db_api.run(update_group_stats, msg.payload[-1].get('aid'), messages)
+            STAGER.submit(msg.payload[-1].get('aid'), msg.payload[-1].get('aid'))
+            SCHEDULER.wake()
+        return await db_api.run(confirm_art_message, msg)
 
 
 class Functions(AdminFunctions):
-    async def no_menu(self, msg):
+    @route()
+    @db_api.threaded
+    def no_menu(self, msg):
         bot_message = BotMessage(
             peer_id=msg.peer_id,
             text="Ошибка доступа",
@@ -410,6 +417,7 @@ class Functions(AdminFunctions):
         bot_message.keyboard.navigation_buttons()
         return bot_message
 
+    @route()
     async def new_user(self, msg):
         bot_message = BotMessage(
             peer_id=msg.peer_id,
@@ -419,15 +427,18 @@ class Functions(AdminFunctions):
         user_info = await vk.get_users_info(msg.peer_id, 'sex')
         if user_info:
             uinfo = user_info[0]
-            db_api.User.create(id=uinfo['id'],
-                               name=f"{uinfo['first_name']} {uinfo['last_name']}",
-                               is_fem=uinfo.get('sex', 0) % 2)
+            await db_api.run(db_api.User.create,
+                             id=uinfo['id'],
+                             name=f"{uinfo['first_name']} {uinfo['last_name']}",
+                             is_fem=uinfo.get('sex', 0) % 2)
         else:
             bot_message.text = 'Упс, при регистрации возникла какая-то ошибка'
         bot_message.keyboard.navigation_buttons()
         return bot_message
 
-    async def main(self, msg):
+    @route(cache=('art', 'group', 'admins'))
+    @db_api.threaded
+    def main(self, msg):
         user = db_api.User.get_or_none(id=msg.peer_id)
         is_admin = db_api.Admins.get_or_none(user=user)
 
@@ -451,9 +462,10 @@ class Functions(AdminFunctions):
         bot_message.keyboard.add_button('Арты', {'mid': 'art'})
 
         if is_admin:
-            groups_count = db_api.Group.select().where(db_api.Group.accepted == 0).count()
-            arts_count = db_api.Art.select().where(db_api.Art.accepted == 0).count()
-            posts_count = db_api.Art.select().where(db_api.Art.accepted == 1).count()
+            groups_count = db_api.get_counter('group', 0)
+            art_counts = db_api.get_counters('art')
+            arts_count = art_counts.get(0, 0)
+            posts_count = art_counts.get(1, 0)
             bot_message.keyboard.add_button(f"Одобрить группы ({groups_count})",
                                             {'mid': 'confirm_group_list'}, row=3)
             bot_message.keyboard.add_button(f"Одобрить арты ({arts_count})",
@@ -467,7 +479,9 @@ class Functions(AdminFunctions):
         bot_message.keyboard.navigation_buttons()
         return bot_message
 
-    async def group(self, msg):
+    @route(cache=('group',))
+    @db_api.threaded
+    def group(self, msg):
         bot_message = BotMessage(
             peer_id=msg.peer_id,
             text="Всё, что связано с группами",
@@ -477,12 +491,8 @@ class Functions(AdminFunctions):
         bot_message.keyboard.add_button('Добавить группу вручную', {'mid': 'add_group'}, row=1, color='primary')
         bot_message.keyboard.add_button('Обновить информацию о ценах', {'mid': 'update_price'}, row=2, color='primary')
 
-        user = db_api.User.get_or_none(id=msg.peer_id)
-        counts = {0: None, 1: None, -1: None}
-        for i in counts:
-            counts[i] = db_api.Group.select()\
-                .where((db_api.Group.accepted == i) & (db_api.Group.add_by == user))\
-                .count()
+        user_counts = db_api.get_counters('group', msg.peer_id)
+        counts = {i: user_counts.get(i, 0) for i in (0, 1, -1)}
         bot_message.keyboard.add_button(f'Проверка ({counts[0]})',
                                         {'mid': 'my_group', 'accept': 0}, row=3)
 
@@ -492,26 +502,24 @@ class Functions(AdminFunctions):
         bot_message.keyboard.add_button(f'Отклонены ({counts[-1]})',
                                         {'mid': 'my_group', 'accept': -1}, row=3)
 
-        groups_count = db_api.Group.select().where(db_api.Group.accepted == 1).count()
+        groups_count = db_api.get_counter('group', 1)
         bot_message.keyboard.add_button(f"Группы художников ({groups_count})",
                                         {'mid': 'view_group_list'}, row=9)
         bot_message.keyboard.navigation_buttons()
         return bot_message
 
-    async def art(self, msg):
+    @route(cache=('art',))
+    @db_api.threaded
+    def art(self, msg):
         bot_message = BotMessage(
             peer_id=msg.peer_id,
             text="Всё, что связано с артами",
             default_payload=msg.payload
         )
-        user = db_api.User.get_or_none(id=msg.peer_id)
         bot_message.keyboard.add_button(f"Найти новый арт", {'mid': 'add_image'},
                                         row=1, color='primary')
-        counts = {0: None, 1: None, 2: None, -1: None}
-        for i in counts:
-            counts[i] = db_api.Art.select()\
-                .where((db_api.Art.accepted == i) & (db_api.Art.add_by == user))\
-                .count()
+        user_counts = db_api.get_counters('art', msg.peer_id)
+        counts = {i: user_counts.get(i, 0) for i in (0, 1, 2, -1)}
         bot_message.keyboard.add_button(f'Проверяются ({counts[0]})',
                                         {'mid': 'my_art', 'accept': 0}, row=3)
 
@@ -526,72 +534,53 @@ class Functions(AdminFunctions):
         bot_message.keyboard.navigation_buttons()
         return bot_message
 
-    async def my_group(self, msg):
+    @route()
+    @db_api.threaded
+    def my_group(self, msg):
         bot_message = BotMessage(
             peer_id=msg.peer_id,
             text="Список групп",
             default_payload=msg.payload
         )
         accept = msg.payload[-1].get('accept', 0)
-        offset = msg.payload[-1].get('offset', 0)
-        user = db_api.User.get_or_none(id=msg.peer_id)
         groups = db_api.Group.select()\
             .where((db_api.Group.accepted == accept) &
-                   (db_api.Group.add_by == user))\
-            .limit(BTN_PER_PAGE).offset(offset * BTN_PER_PAGE)
-        groups_count = db_api.Group.select(). \
-            where((db_api.Group.accepted == accept) &
-                   (db_api.Group.add_by == user)) \
-            .count()
+                   (db_api.Group.add_by == msg.peer_id))
+        groups, prev_page, next_page = db_api.get_page(groups, (db_api.Group.id,),
+                                                       **get_cursor(msg.payload[-1]), limit=BTN_PER_PAGE)
         for g in groups:
             bot_message.keyboard.add_button(
                 g.name[:35], {'mid': 'view_group', 'gid': g.id}
             )
-        bot_message.keyboard.add_button('<-', {'mid': 'my_group',
-                                               'accept': accept,
-                                               'offset': max(offset - 1, 0)},
-                                        row=9)
-        bot_message.keyboard.add_button('->', {'mid': 'my_group',
-                                               'accept': accept,
-                                               'offset': min(offset + 1, groups_count // 16)},
-                                        row=9)
+        page_buttons(bot_message.keyboard, {'mid': 'my_group', 'accept': accept}, prev_page, next_page)
         bot_message.keyboard.navigation_buttons()
         return bot_message
 
-    async def my_art(self, msg):
+    @route()
+    @db_api.threaded
+    def my_art(self, msg):
         bot_message = BotMessage(
             peer_id=msg.peer_id,
             text="Список артов",
             default_payload=msg.payload
         )
         accept = msg.payload[-1].get('accept', 0)
-        offset = msg.payload[-1].get('offset', 0)
-        user = db_api.User.get_or_none(id=msg.peer_id)
         arts = db_api.Art.select() \
             .where((db_api.Art.accepted == accept) &
-                   (db_api.Art.add_by == user)) \
-            .limit(BTN_PER_PAGE).offset(offset * BTN_PER_PAGE)
-        arts_count = db_api.Art.select(). \
-            where((db_api.Art.accepted == accept) &
-                  (db_api.Art.add_by == user)) \
-            .count()
+                   (db_api.Art.add_by == msg.peer_id))
+        arts, prev_page, next_page = db_api.get_page(arts, (db_api.Art.id,),
+                                                     **get_cursor(msg.payload[-1]), limit=BTN_PER_PAGE)
         for a in arts:
             post_time = time.strftime('%d.%m', time.localtime(a.add_time))
             bot_message.keyboard.add_button(
                 f"{post_time} {a.from_group.name[:40]}",
                 {'mid': 'view_art', 'aid': a.id}
             )
-        bot_message.keyboard.add_button('<-', {'mid': 'my_art',
-                                               'accept': accept,
-                                               'offset': max(offset - 1, 0)},
-                                        row=9)
-        bot_message.keyboard.add_button('->', {'mid': 'my_art',
-                                               'accept': accept,
-                                               'offset': min(offset + 1, arts_count // BTN_PER_PAGE)},
-                                        row=9)
+        page_buttons(bot_message.keyboard, {'mid': 'my_art', 'accept': accept}, prev_page, next_page)
         bot_message.keyboard.navigation_buttons()
         return bot_message
 
+    @route()
     async def auto_add_group(self, msg):
         bot_message = BotMessage(
             peer_id=msg.peer_id,
@@ -603,7 +592,7 @@ class Functions(AdminFunctions):
             .where(db_api.Group.accepted > 0)\
             .order_by(db_api.Group.last_scan)\
             .limit(10)
-        group = random.choice(list(scan_group_list))
+        group = random.choice(await db_api.run(list, scan_group_list))
         groups_info = await vk.get_groups_info(group.id, 'links')
         template = lambda l, t: l[l.find(t) + len(t):]
         links = list()
@@ -622,13 +611,13 @@ class Functions(AdminFunctions):
                            if ng['is_closed'] == 0 and ng.get('members_count', 0) < MAX_GROUP_SUBS]
         new_group_ids = [ng['id'] for ng in new_groups_info]
         groups_in_db = db_api.Group.select().where(db_api.Group.id.in_(new_group_ids))
-        group_ids_in_db = [g.id for g in groups_in_db]
+        group_ids_in_db = [g.id for g in await db_api.run(list, groups_in_db)]
         groups_not_in_db = [ng for ng in new_groups_info if ng['id'] not in group_ids_in_db]
         scanned_group_link = get_group_link(group.id, group.name)
         if not groups_not_in_db:
             bot_message.text = f"Бот просканировал группу {scanned_group_link} и не нашел новых ссылок."
             group.last_scan = time.time()
-            group.save()
+            await db_api.run(group.save)
             bot_message.keyboard.add_button('Попробовать снова', {'mid': 'auto_add_group'})
         else:
             new_group = random.choice(groups_not_in_db)
@@ -647,11 +636,13 @@ class Functions(AdminFunctions):
                                             color='negative')
             if len(groups_not_in_db) == 1:
                 group.last_scan = time.time()
-                group.save()
+                await db_api.run(group.save)
         bot_message.keyboard.navigation_buttons()
         return bot_message
 
-    async def add_group(self, msg):
+    @route(cache=(), per_user=False)
+    @db_api.threaded
+    def add_group(self, msg):
         bot_message = BotMessage(
             peer_id=msg.peer_id,
             text="Отправьте 3 поста с рисунками художника.\n"
@@ -664,6 +655,7 @@ class Functions(AdminFunctions):
         bot_message.keyboard.navigation_buttons()
         return bot_message
 
+    @route(keys=('gid',))
     async def save_not_group(self, msg):
         bot_message = BotMessage(
             peer_id=msg.peer_id,
@@ -674,7 +666,7 @@ class Functions(AdminFunctions):
         group_info = await vk.get_groups_info(msg.payload[-1].get('gid'), 'members_count')
         group_info = group_info[0]
         if not msg.payload[-1].get('del', 1):
-            db_api.Group.delete().where(db_api.Group.id == msg.payload[-1].get('gid')).execute()
+            await db_api.run(db_api.Group.delete().where(db_api.Group.id == msg.payload[-1].get('gid')).execute)
             vk_link = get_group_link(group_info['id'], group_info['name'])
             bot_message.text = f"Группа {vk_link} удалена из базы.\n" \
                                f"Если это группа художника, " \
@@ -688,13 +680,14 @@ class Functions(AdminFunctions):
                                              'gid': group_info['id']},
                                             color='negative')
         else:
-            user = db_api.User.get_or_none(id=msg.peer_id)
-            group = db_api.Group.create(id=group_info['id'],
-                                        name=group_info['name'],
-                                        add_by=user,
-                                        subs=group_info.get('members_count', -1),
-                                        last_update=int(time.time()),
-                                        accepted=-2)
+            user = await db_api.run(db_api.User.get_or_none, id=msg.peer_id)
+            group = await db_api.run(db_api.Group.create,
+                                     id=group_info['id'],
+                                     name=group_info['name'],
+                                     add_by=user,
+                                     subs=group_info.get('members_count', -1),
+                                     last_update=int(time.time()),
+                                     accepted=-2)
             vk_link = get_group_link(group.id, group.name)
             bot_message.text = f"Группа {vk_link} добавлена в базу как неподходящая для поиска артов.\n"
             bot_message.keyboard.add_button('Отменить', {'mid': 'save_not_group',
@@ -704,6 +697,7 @@ class Functions(AdminFunctions):
         bot_message.keyboard.navigation_buttons()
         return bot_message
 
+    @route()
     async def save_group(self, msg):
         posts = []
 
@@ -723,7 +717,7 @@ class Functions(AdminFunctions):
             default_payload=msg.payload,
             save_menu=False
         )
-        can_add, err_message = check_group_add_posts(posts, msg.payload[-1].get('gid', 0))
+        can_add, err_message = await db_api.run(check_group_add_posts, posts, msg.payload[-1].get('gid', 0))
         if not can_add:
             bot_message.text = err_message
             if msg.payload[-1].get('gid', 0):
@@ -731,34 +725,36 @@ class Functions(AdminFunctions):
             else:
                 bot_message.keyboard.add_button('Попробовать снова', {'mid': 'add_group'}, color='primary')
         else:
-            user = db_api.User.get_or_none(id=msg.peer_id)
+            user = await db_api.run(db_api.User.get_or_none, id=msg.peer_id)
             group_info = await vk.get_groups_info(-posts[0]['to_id'], 'members_count')
-            print('group_info', group_info)
+            logging.debug(f'group info {group_info}')
             group_info = group_info[0]
             likes = sum([i['likes']['count'] for i in posts]) / len(posts)
             views = sum([i['views']['count'] for i in posts]) / len(posts)
-            group = db_api.Group.create(id=group_info['id'],
-                                        name=group_info['name'],
-                                        add_by=user,
-                                        likes=likes,
-                                        views=views,
-                                        subs=group_info.get('members_count', -1),
-                                        last_update=int(time.time()))
+            group = await db_api.run(db_api.Group.create,
+                                     id=group_info['id'],
+                                     name=group_info['name'],
+                                     add_by=user,
+                                     likes=likes,
+                                     views=views,
+                                     subs=group_info.get('members_count', -1),
+                                     last_update=int(time.time()))
             vk_link = f"@club{group.id} ({group.name})"
 
             future_arts = list()
             for post in posts:
                 photo = [a['photo'] for a in post['attachments'] if a['type'] == 'photo'][0]
-                image_url = sorted(photo['sizes'], key=lambda x: x['width'] * x['height'])[-1]['url']
+                image_url, hash_url = get_photo_urls(photo)
                 source = f"wall{post['from_id']}_{post['id']}"
                 task = asyncio.create_task(save_art(image_url=image_url,
+                                                    hash_url=hash_url,
                                                     source=source,
                                                     add_by=user,
                                                     from_group=group,
                                                     msg_id=post['msg_id'],
                                                     accepted=-2))
                 future_arts.append(task)
-            arts = [art for art, is_new in await asyncio.gather(*future_arts)]
+            arts = [art for art, is_new in await vk_api.UPLOADS.gather(*future_arts)]
             bot_message.text = f"Группа {vk_link} добавлена в базу.\n" \
                                f"После одобрения администратором её можно будет найти в общем списке."
             bot_message.attachments = [a.vk_id for a in arts]
@@ -769,7 +765,9 @@ class Functions(AdminFunctions):
         bot_message.keyboard.navigation_buttons()
         return bot_message
 
-    async def view_group_list(self, msg):
+    @route()
+    @db_api.threaded
+    def view_group_list(self, msg):
         order_list = {0: "дате последнего обновления",
                       1: "алфавиту",
                       2: "Ценам",
@@ -780,61 +778,56 @@ class Functions(AdminFunctions):
             text=F"Список добавленных пользователями групп, отсортированный по {order_list[order]}.",
             default_payload=msg.payload
         )
-        offset = msg.payload[-1].get('offset', 0)
+        cursor = get_cursor(msg.payload[-1])
 
         if order == 2:
-            prices = db_api.Price.select() \
-                .order_by(db_api.Price.accepted < 0, db_api.Price.head + db_api.Price.half + db_api.Price.full) \
-                .offset(offset * BTN_PER_PAGE) \
-                .limit(BTN_PER_PAGE)
-            posts_count = db_api.Price.select().count()
+            prices, prev_page, next_page = db_api.get_page(db_api.Price.select(),
+                                                           (db_api.PRICE_ORDER, db_api.Price.group),
+                                                           **cursor, limit=BTN_PER_PAGE)
             groups = [p.group for p in prices]
         else:
+            # every order ends with the id, the indexes on (accepted, ...) hold it as the rowid
             if order == 1:
-                order_by = db_api.Group.name
+                keys, desc = (db_api.Group.name, db_api.Group.id), False
             elif order == 3:
-                order_by = db_api.Group.subs
+                keys, desc = (db_api.Group.subs, db_api.Group.id), False
             else:
-                order_by = db_api.Group.last_update.desc()
-
-            groups = db_api.Group.select()\
-                .where(db_api.Group.accepted == 1)\
-                .order_by(order_by)\
-                .offset(offset * BTN_PER_PAGE)\
-                .limit(BTN_PER_PAGE)
+                keys, desc = (db_api.Group.last_update, db_api.Group.id), True
 
-            posts_count = db_api.Group.select().\
-                where(db_api.Group.accepted == 1)\
-                .count()
+            groups = db_api.Group.select().where(db_api.Group.accepted == 1)
+            groups, prev_page, next_page = db_api.get_page(groups, keys, **cursor, limit=BTN_PER_PAGE, desc=desc)
         for g in groups:
             bot_message.keyboard.add_button(
                 g.name[:35], {'mid': 'view_group', 'gid': g.id}
             )
-        bot_message.keyboard.add_button(
-            '<-',
-            {'mid': 'view_group_list',
-             'offset': max(offset-1, 0),
-             'sort': order},
-            row=9
-        )
+        if prev_page:
+            bot_message.keyboard.add_button(
+                '<-',
+                {'mid': 'view_group_list',
+                 'before': prev_page,
+                 'sort': order},
+                row=9
+            )
         bot_message.keyboard.add_button(
             'Порядок',
             {'mid': 'view_group_list',
-             'offset': offset,
              'sort': order + 1 if order + 1 in order_list else 0},
             row=9
         )
-        bot_message.keyboard.add_button(
-            '->',
-            {'mid': 'view_group_list',
-             'offset': min(offset+1, posts_count//BTN_PER_PAGE),
-             'sort': order},
-            row=9,
-        )
+        if next_page:
+            bot_message.keyboard.add_button(
+                '->',
+                {'mid': 'view_group_list',
+                 'after': next_page,
+                 'sort': order},
+                row=9,
+            )
         bot_message.keyboard.navigation_buttons()
         return bot_message
 
-    async def view_group(self, msg):
+    @route(keys=('gid',))
+    @db_api.threaded
+    def view_group(self, msg):
         group = db_api.Group.get_or_none(id=msg.payload[-1].get('gid'))
         price = db_api.Price.get_or_none(group=group)
         group_link = get_group_link(group.id, group.name)
@@ -894,7 +887,9 @@ class Functions(AdminFunctions):
         bot_message.keyboard.navigation_buttons()
         return bot_message
 
-    async def add_image(self, msg):
+    @route()
+    @db_api.threaded
+    def add_image(self, msg):
         min_time = int(time.time() - TIME_BETWEEN_POSTS_FROM_GROUP)
         confirmig_posts = db_api.Art.select(db_api.Art.from_group).where(db_api.Art.accepted.in_([0, 1]))
         groups = db_api.Group.select()\
@@ -940,6 +935,7 @@ class Functions(AdminFunctions):
         bot_message.keyboard.navigation_buttons()
         return bot_message
 
+    @route(keys=('gid',))
     async def verify_image(self, msg):
         arts_tasks = []
         already_in_base = False
@@ -954,18 +950,23 @@ class Functions(AdminFunctions):
                 post_attachments = attachment['wall'].get('attachments', [])
                 post_images = [i['photo'] for i in post_attachments if i['type'] == 'photo']
                 for photo in post_images:
-                    image_url = sorted(photo['sizes'], key=lambda x: x['width'] * x['height'])[-1]['url']
+                    image_url, hash_url = get_photo_urls(photo)
                     if len(arts_tasks) >= 10:
                         break
-                    elif db_api.Art.get_or_none(url=image_url):
+                    elif await db_api.run(db_api.Art.get_or_none, url=image_url):
                         already_in_base = True
                         continue
                     task = asyncio.create_task(prepare_art(image_url=image_url,
+                                                           hash_url=hash_url,
                                                            group_id=attachment['wall']['from_id'],
                                                            post_id=attachment['wall']['id'],
                                                            msg_id=message.message_id))
                     arts_tasks.append(task)
-        arts = await asyncio.gather(*arts_tasks)
+        arts = await vk_api.UPLOADS.gather(*arts_tasks)
+        if None in arts:
+            # similar pictures are already in the base
+            already_in_base = True
+            arts = [art for art in arts if art]
         bot_message = BotMessage(
             peer_id=msg.peer_id,
             text="",
@@ -996,17 +997,23 @@ class Functions(AdminFunctions):
         bot_message.keyboard.navigation_buttons()
         return bot_message
 
-    async def save_art(self, msg):
+    @route(keys=('gid', 'pid', 'url', 'art', 'msgid'))
+    @db_api.threaded
+    def save_art(self, msg):
         source = f"wall-{msg.payload[-1].get('gid')}_{msg.payload[-1].get('pid')}"
         user = db_api.User.get_or_none(id=msg.peer_id)
         group = db_api.Group.get_or_none(id=msg.payload[-1].get('gid'))
+        image_hash = msg.payload[-1].get('ph')
         saved_art = db_api.Art.create(vk_id=msg.payload[-1].get('art'),
                                       url=msg.payload[-1].get('url'),
                                       source=source,
                                       add_by=user,
                                       from_group=group,
                                       add_time=time.time(),
-                                      message_id=msg.payload[-1].get('msgid'))
+                                      message_id=msg.payload[-1].get('msgid'),
+                                      phash=image_hash)
+        if image_hash:
+            HASH_INDEX.add(phash.from_hex(image_hash), saved_art.id)
         group.last_post = time.time()
         group.save()
         bot_message = BotMessage(
@@ -1021,7 +1028,9 @@ class Functions(AdminFunctions):
         bot_message.keyboard.navigation_buttons()
         return bot_message
 
-    async def art_tags(self, msg):
+    @route(keys=('aid',))
+    @db_api.threaded
+    def art_tags(self, msg):
         art = db_api.Art.get_or_none(id=msg.payload[-1].get('aid'))
         bot_message = BotMessage(
             peer_id=msg.peer_id,
@@ -1042,11 +1051,10 @@ class Functions(AdminFunctions):
                            db_api.ArtTag.tag == tag)\
                     .execute()
 
-        offset = msg.payload[-1].get('offset', 0)
-        tags_count = db_api.Tag.select().count()
-        all_tags = db_api.Tag.select().limit(BTN_PER_PAGE)\
-            .offset(offset * BTN_PER_PAGE)\
-            .order_by(db_api.Tag.title)
+        cursor = get_cursor(msg.payload[-1])
+        all_tags, prev_page, next_page = db_api.get_page(db_api.Tag.select(),
+                                                         (db_api.Tag.title, db_api.Tag.id),
+                                                         **cursor, limit=BTN_PER_PAGE)
         selected_tags = [t.tag for t in db_api.ArtTag.select().where(db_api.ArtTag.art == art)]
         for t in all_tags:
             color = 'default'
@@ -1058,22 +1066,17 @@ class Functions(AdminFunctions):
                                                       'aid': art.id,
                                                       'tid': t.id,
                                                       'add': add,
-                                                      'offset': offset}, color=color)
+                                                      **cursor}, color=color)
         tag_list = [f"#{t.title.replace(' ', '_')}" for t in selected_tags]
         tag_list.sort()
         bot_message.text += '\n'.join(tag_list)
-        bot_message.keyboard.add_button('<-', {'mid': 'art_tags',
-                                               'aid': art.id,
-                                               'offset': max(offset - 1, 0)},
-                                        row=9)
-        bot_message.keyboard.add_button('->', {'mid': 'art_tags',
-                                               'aid': art.id,
-                                               'offset': min(offset + 1, tags_count // BTN_PER_PAGE)},
-                                        row=9)
+        page_buttons(bot_message.keyboard, {'mid': 'art_tags', 'aid': art.id}, prev_page, next_page)
         bot_message.keyboard.navigation_buttons()
         return bot_message
 
-    async def view_art(self, msg):
+    @route(keys=('aid',))
+    @db_api.threaded
+    def view_art(self, msg):
         art = db_api.Art.get_or_none(id=msg.payload[-1].get('aid'))
         group_link = get_group_link(art.from_group.id, art.from_group.name)
         user_link = f"@id{art.add_by.id} ({art.add_by.name})"
@@ -1094,7 +1097,9 @@ class Functions(AdminFunctions):
         bot_message.keyboard.navigation_buttons()
         return bot_message
 
-    async def update_price(self, msg):
+    @route()
+    @db_api.threaded
+    def update_price(self, msg):
         actual_time = time.time() - 30 * 24 * 60 * 60
         groups_with_info = db_api.Price.select(db_api.Price.group)\
             .where((db_api.Price.last_scan > actual_time) &
@@ -1130,7 +1135,9 @@ class Functions(AdminFunctions):
         bot_message.keyboard.navigation_buttons()
         return bot_message
 
-    async def save_order_info(self, msg):
+    @route(keys=('gid',))
+    @db_api.threaded
+    def save_order_info(self, msg):
         user = db_api.User.get_or_none(id=msg.peer_id)
         group = db_api.Group.get_or_none(id=msg.payload[-1].get('gid'))
         price = db_api.Price.get_or_none(group=group)
@@ -1207,7 +1214,9 @@ class Functions(AdminFunctions):
         bot_message.keyboard.navigation_buttons()
         return bot_message
 
-    async def users_top(self, msg):
+    @route(cache=('art', 'group', 'user'), per_user=False)
+    @db_api.threaded
+    def users_top(self, msg):
         bot_message = BotMessage(
             peer_id=msg.peer_id,
             text="Топ самых активных пользователей.\n"
@@ -1247,6 +1256,67 @@ class Functions(AdminFunctions):
         return bot_message
 
 
+FUNCTIONS = Functions()
+
+
+async def call_menu(menu, msg):
+    # only what the handler read from the database is cached, by the last payload.
+    # the buttons are rebuilt on the current stack, the keyboard cache renders them
+    if menu.cache is None:
+        return await menu.handler(FUNCTIONS, msg)
+    payload = msg.payload[-1] if msg.payload else {}
+    key = (menu.mid, msg.peer_id if menu.per_user else 0, json.dumps(payload, ensure_ascii=False, sort_keys=True))
+    content = RENDER_CACHE.get(key)
+    if content is None:
+        since = RENDER_CACHE.version(menu.cache)
+        bot_message = await menu.handler(FUNCTIONS, msg)
+        keyboard = bot_message.keyboard
+        if keyboard.parts is not None:
+            content = (bot_message.text, list(bot_message.attachments), bot_message.forward_messages,
+                       keyboard.inline, keyboard.one_time, keyboard.save_menu, list(keyboard.parts))
+            RENDER_CACHE.put(key, content, menu.cache, since)
+        return bot_message
+    text, attachments, forward_messages, inline, one_time, save_menu, parts = content
+    keyboard = Keyboard(default_payload=msg.payload, inline=inline, one_time=one_time, save_menu=save_menu)
+    keyboard.add_parts(parts)
+    return BotMessage(peer_id=msg.peer_id, text=text, attachments=list(attachments),
+                      forward_messages=forward_messages, keyboard=keyboard)
+
+
+async def dispatch(mid, msg):
+    menu = ROUTES.get(mid, ROUTES['no_menu'])
+    payload = msg.payload[-1] if msg.payload else {}
+    if any(key not in payload for key in menu.keys):
+        logging.warning(f'{mid}: payload without {menu.keys}: {payload}')
+        menu = ROUTES['no_menu']
+    elif menu.admin_only and not await db_api.run(db_api.is_admin, msg.peer_id):
+        menu = ROUTES['no_menu']
+
+    timeout = menu.timeout
+    time_left = vk_api.get_time_left()
+    if time_left is not None:
+        timeout = max(min(timeout, time_left - REPLY_SEND_TIME), 0)
+    start_time = time.time()
+    try:
+        return await asyncio.wait_for(call_menu(menu, msg), timeout)
+    except asyncio.TimeoutError:
+        menu.timeouts += 1
+        logging.error(f'{menu.mid}: timeout after {round(timeout, 3)}s.')
+        bot_message = BotMessage(
+            peer_id=msg.peer_id,
+            text="Не получилось ответить вовремя, попробуйте еще раз",
+            default_payload=msg.payload,
+            save_menu=False
+        )
+        bot_message.keyboard.navigation_buttons()
+        return bot_message
+    except Exception:
+        menu.errors += 1
+        raise
+    finally:
+        menu.record(time.time() - start_time)
+
+
 def check_group_add_posts(posts, group_id):
     start_time = list(time.localtime(time.time()))
     start_time[1] -= 3
@@ -1264,7 +1334,7 @@ def check_group_add_posts(posts, group_id):
 
     if not all([-i.get('to_id') == from_info.get('id') for i in posts]):
         for i in posts:
-            print('group from', i.get('from'))
+            logging.debug(f"group from {i.get('from')}")
         return False, "Все посты должны быть из одной группы"
 
     if from_info['is_closed']:
@@ -1288,173 +1358,554 @@ def check_group_add_posts(posts, group_id):
     return True, ''
 
 
-async def save_art(image_url, source, add_by, from_group, msg_id, accepted=0):
-    old_image = db_api.Art.get_or_none(url=image_url)
+def confirm_art_message(msg):
+    art = db_api.Art.get_or_none(id=msg.payload[-1].get('aid'))
+    group_link = get_group_link(art.from_group.id, art.from_group.name)
+    user_link = f"@id{art.add_by.id} ({art.add_by.name})"
+    selected_tags = db_api.ArtTag.select().where(db_api.ArtTag.art == art)
+    tag_list = [f"#{t.tag.title.replace(' ', '_')}" for t in selected_tags]
+    tag_list = '\n'.join(sorted(tag_list))
+
+    art_accept = msg.payload[-1].get('accept')
+    bot_message = BotMessage(
+        peer_id=msg.peer_id,
+        text=f"{tag_list}\n\n"
+             f"Группа {group_link}\n"
+             f"Пост: vk.com/{art.source}\n"
+             f"Добавил(а) {user_link}",
+        default_payload=msg.payload,
+        save_menu=not art_accept,
+        attachments=[art.vk_id],
+        forward_messages=art.message_id
+    )
+
+    if art_accept == 1:
+        bot_message.keyboard.add_button('Отклонить',
+                                        {'mid': 'confirm_art',
+                                         'aid': art.id,
+                                         'accept': -1},
+                                        color='negative')
+        bot_message.keyboard.add_button('К списку',
+                                        {'mid': 'confirm_art_list'},
+                                        row=2)
+        arts = list(db_api.Art.select().where(db_api.Art.accepted == 0).limit(1))
+        if arts:
+            bot_message.keyboard.add_button('Следующий',
+                                            {'mid': 'confirm_art',
+                                             'aid': arts[0].id},
+                                            row=2)
+
+    elif art_accept == -1:
+        last_art = db_api.Art.select()\
+            .where(db_api.Art.accepted == 2)\
+            .order_by(db_api.Art.add_time.desc())\
+            .limit(1)
+        last_art_time = list(last_art)[0].add_time if list(last_art) else 0
+        art.accepted = -1
+        art.from_group.last_post = last_art_time
+        art.from_group.save()
+        art.save()
+        bot_message.keyboard.add_button('Одобрить',
+                                        {'mid': 'confirm_art',
+                                         'aid': art.id,
+                                         'accept': 1},
+                                        color='positive')
+        bot_message.keyboard.add_button('К списку',
+                                        {'mid': 'confirm_art_list'},
+                                        row=2)
+        arts = list(db_api.Art.select().where(db_api.Art.accepted == 0).limit(1))
+        if arts:
+            bot_message.keyboard.add_button('Следующий',
+                                            {'mid': 'confirm_art',
+                                             'aid': arts[0].id},
+                                            row=2)
+    else:
+        bot_message.keyboard.add_button('Одобрить',
+                                        {'mid': 'confirm_art',
+                                         'aid': art.id,
+                                         'accept': 1},
+                                        color='positive')
+        bot_message.keyboard.add_button('Отклонить',
+                                        {'mid': 'confirm_art',
+                                         'aid': art.id,
+                                         'accept': -1},
+                                        color='negative')
+
+        bot_message.keyboard.add_button('Теги', {'mid': 'art_tags',
+                                                 'aid': art.id}, row=2)
+    bot_message.keyboard.navigation_buttons()
+    return bot_message
+
+
+def accept_art(art_id):
+    art = db_api.Art.get_or_none(id=art_id)
+    art.accepted = 1
+    art.save()
+    group_arts = db_api.Art.select()\
+        .where((db_api.Art.from_group == art.from_group) &
+               (db_api.Art.accepted > 0))\
+        .order_by(db_api.Art.add_time.desc())\
+        .limit(10)
+    return [str(a.message_id) for a in group_arts]
+
+
+def update_group_stats(art_id, messages):
+    art = db_api.Art.get_or_none(id=art_id)
+    likes = list()
+    views = list()
+    for message in messages.get('response', {}).get('items', []):
+        for attachment in message.get('attachments', []):
+            if attachment['type'] == 'wall':
+                l = attachment['wall'].get('likes', {}).get('count', 0)
+                if l:
+                    likes.append(l)
+                v = attachment['wall'].get('views', {}).get('count', 0)
+                if v:
+                    views.append(v)
+    if len(likes):
+        art.from_group.likes = sum(likes)/len(likes)
+    if len(views):
+        art.from_group.views = sum(views)/len(views)
+    art.from_group.last_post = art.add_time
+    art.from_group.save()
+
+
+def get_photo_urls(photo):
+    # the largest size is uploaded, the smallest one that is still big enough is hashed
+    sizes = sorted(photo['sizes'], key=lambda x: x['width'] * x['height'])
+    small = next((s for s in sizes if max(s['width'], s['height']) >= HASH_MIN_SIZE), sizes[-1])
+    return sizes[-1]['url'], small['url']
+
+
+async def get_image_hash(image_url):
+    if phash.Image is None:
+        return None
+    async with vk.get_session() as session:
+        try:
+            image, content_type = await vk.download_image(image_url, session)
+        except Exception as error_msg:
+            logging.error(f'download file: {error_msg!r}')
+            return None
+    if image is None:
+        return None
+    return await asyncio.get_running_loop().run_in_executor(None, phash.dhash, image)
+
+
+async def find_duplicate(image_hash):
+    if image_hash is None:
+        return None
+    if not HASH_INDEX.loaded:
+        HASH_INDEX.load(await db_api.run(db_api.get_art_hashes))
+    for distance, art_id in HASH_INDEX.find(image_hash, HASH_DISTANCE):
+        art = await db_api.run(db_api.Art.get_or_none, id=art_id)
+        if art:
+            return art
+    return None
+
+
+async def save_art(image_url, hash_url, source, add_by, from_group, msg_id, accepted=0):
+    old_image = await db_api.run(db_api.Art.get_or_none, url=image_url)
+    if old_image:
+        return old_image, False
+    image_hash = await get_image_hash(hash_url)
+    old_image = await find_duplicate(image_hash)
     if old_image:
         return old_image, False
 
-    future_vk_id = vk.upload_image(image_url)
-    new_image = db_api.Art.create(vk_id=await future_vk_id,
-                                  url=image_url,
-                                  source=source,
-                                  add_by=add_by,
-                                  from_group=from_group,
-                                  add_time=time.time(),
-                                  message_id=msg_id,
-                                  accepted=accepted)
+    future_vk_id = upload_image(vk, image_url)
+    new_image = await db_api.run(db_api.Art.create,
+                                 vk_id=await future_vk_id,
+                                 url=image_url,
+                                 source=source,
+                                 add_by=add_by,
+                                 from_group=from_group,
+                                 add_time=time.time(),
+                                 message_id=msg_id,
+                                 accepted=accepted,
+                                 phash=phash.to_hex(image_hash) if image_hash is not None else None)
+    if image_hash is not None:
+        HASH_INDEX.add(image_hash, new_image.id)
     return new_image, True
 
 
-async def prepare_art(image_url, group_id, post_id, msg_id):
-    return {
+async def upload_image(api, image_url, **kwargs):
+    # the same source image is uploaded for the preview, the art and the wall post,
+    # every upload target is cached separately
+    target = f"{kwargs.get('server_method', 'photos.getMessagesUploadServer')}:" \
+             f"{kwargs.get('group_id') or kwargs.get('peer_id', 0)}"
+    attachment = await db_api.run(db_api.get_cached_upload, image_url, target)
+    if attachment:
+        return attachment
+    attachment = await api.upload_image(image_url, **kwargs)
+    if attachment and attachment != kwargs.get('default_image', ''):
+        await db_api.run(db_api.save_cached_upload, image_url, target, attachment)
+    return attachment
+
+
+async def prepare_art(image_url, hash_url, group_id, post_id, msg_id):
+    image_hash = await get_image_hash(hash_url)
+    if await find_duplicate(image_hash):
+        return None
+    art = {
         'gid': abs(group_id),
         'pid': post_id,
         'url': image_url,
-        'art': await vk.upload_image(image_url),
+        'art': await upload_image(vk, image_url),
         'msgid': msg_id
     }
+    if image_hash is not None:
+        art['ph'] = phash.to_hex(image_hash)
+    return art
+
+
+class WallScheduler:
+    # keeps the postponed posts of the group wall filled with accepted arts.
+    # the postponed calendar is mirrored locally, free slots are taken from a heap
+    def __init__(self, post_times=POST_TIMES):
+        self.post_times = post_times
+        # dates taken on the wall, for free_slots, and the number of postponed posts,
+        # several posts can share a date
+        self.postponed = set()
+        self.postponed_count = 0
+        self.api = None
+        self.group_id = 0
+        self.screen_name = ''
+        self.wake_event = None
+        # arts skipped by publish while their wall photo was being staged
+        self.waiting = set()
+
+    def wake(self):
+        if self.wake_event:
+            self.wake_event.set()
+
+    async def start(self):
+        group_info = await vk.get_groups_info('')
+        self.group_id = group_info[0]['id']
+        self.screen_name = group_info[0]['screen_name']
+        token = CONF.get('VK', 'user_token', fallback='')
+        self.api = vk_api.VkApi(token, vk.v, rate_limit=CONF.getint('VK', 'user_rate_limit', fallback=3))
+        await self.api.start(vk.session)
+        self.wake_event = asyncio.Event()
+
+    async def sync(self):
+        wall_info = await self.api.request_get('wall.get', {'owner_id': -self.group_id,
+                                                            'filter': 'postponed',
+                                                            'count': 100},
+                                               priority=vk_api.PRIORITY_BACKGROUND)
+        if 'response' not in wall_info:
+            logging.error(f'wall_info {wall_info}')
+            return False
+        self.postponed = {i['date'] for i in wall_info['response']['items']}
+        self.postponed_count = wall_info['response']['count']
+        return True
+
+    def free_slots(self, count, now=None):
+        now = now if now is not None else time.time()
+        slots = list()
+        post_day = now // DAY * DAY + 3 * HOUR
+        while len(slots) < count:
+            for post_time in self.post_times:
+                slot = int(post_day + post_time)
+                if slot > now and slot not in self.postponed:
+                    heapq.heappush(slots, slot)
+            post_day += DAY
+        return [heapq.heappop(slots) for _ in range(count)]
+
+    async def fill(self):
+        # returns how long to sleep if nobody wakes the scheduler
+        if not await self.sync():
+            return 5 * 60
+        free = MAX_POSTPONED_POSTS - self.postponed_count
+        if free <= 0:
+            # nothing to do until the nearest postponed post is published
+            next_post = min(self.postponed) if self.postponed else time.time()
+            return min(max(next_post - time.time(), 60), 30 * 60)
 
-
-async def post_arts():
-    h = 60 * 60
-    post_time_list = [1 * h, 4 * h, 7 * h, 10 * h, 13 * h, 15 * h, 17 * h, 19 * h, 21 * h, 23 * h]
-    group_info = await vk.get_groups_info('')
-    group_id = group_info[0]['id']
-    screen_name = group_info[0]['screen_name']
-    token = CONF.get('VK', 'user_token', fallback='')
-    post_api = vk_api.VkApi(token, vk.v)
-    while True:
         add_time = time.time() - 10 * 60
-        art_to_post = db_api.Art.select()\
-            .where((db_api.Art.accepted == 1) &
-                   (db_api.Art.add_time < add_time))\
-            .order_by(db_api.Art.add_time)\
-            .limit(1)
-        art_list = list(art_to_post)
-        if art_list:
-            art = art_list[0]
-            wall_info = asyncio.create_task(post_api.request_get('wall.get',
-                                                                 {'owner_id': -group_id,
-                                                                  'filter': 'postponed'}))
-
-            selected_tags = db_api.ArtTag.select().where(db_api.ArtTag.art == art)
-            tag_list = '\n'.join([f"#{t.tag.title.replace(' ', '_')}@{screen_name}" for t in selected_tags])
-            group_link = get_group_link(art.from_group.id, art.from_group.name)
-
-            wall_info = await wall_info
-            # print(wall_info)
-            if 'response' not in wall_info:
-                logging.error(f'wall_info {wall_info}')
-                await asyncio.sleep(5 * 60)
+        arts = await db_api.run(list, db_api.Art.select()
+                                .where((db_api.Art.accepted == 1) & (db_api.Art.add_time < add_time))
+                                .order_by(db_api.Art.add_time)
+                                .limit(free))
+        if arts:
+            await self.publish(arts)
+
+        # arts accepted less than 10 minutes ago are published as soon as they are old enough
+        next_art = await db_api.run(db_api.Art.select(peewee.fn.MIN(db_api.Art.add_time))
+                                    .where(db_api.Art.accepted == 1).scalar)
+        if next_art is None:
+            await self.notify_admins()
+            return 15 * 60
+        delay = next_art + 10 * 60 - time.time()
+        return delay if 0 < delay < 15 * 60 else 15 * 60
+
+    def upload(self, art):
+        return upload_image(self.api, art.url, group_id=self.group_id,
+                            server_method='photos.getWallUploadServer',
+                            save_method='photos.saveWallPhoto',
+                            priority=vk_api.PRIORITY_BACKGROUND)
+
+    async def publish(self, arts):
+        # staged arts already have their wall photo, the rest are uploaded here.
+        # arts being staged right now wait for the stager, it wakes the scheduler
+        busy = [art for art in arts if art.id in STAGING]
+        self.waiting.update(art.id for art in busy)
+        arts = [art for art in arts if art.id not in STAGING]
+        staged = await db_api.run(get_wall_photos, [art.id for art in arts if not art.wall_photo])
+        for art in arts:
+            art.wall_photo = art.wall_photo or staged.get(art.id)
+        unstaged = [art for art in arts if not art.wall_photo]
+        STAGING.update(art.id for art in unstaged)
+        try:
+            images = vk_api.UPLOADS.gather(*[self.upload(art) for art in unstaged])
+            texts = asyncio.gather(*[db_api.run(get_post_text, art, self.screen_name) for art in arts])
+            images, texts = await asyncio.gather(images, texts)
+            for art, image in zip(unstaged, images):
+                if image:
+                    # kept if the post fails, the next try reuses it
+                    art.wall_photo = image
+                    await db_api.run(db_api.Art.update(wall_photo=image).where(db_api.Art.id == art.id).execute)
+        finally:
+            STAGING.difference_update(art.id for art in unstaged)
+        for art, slot, post_text in zip(arts, self.free_slots(len(arts)), texts):
+            image = art.wall_photo
+            if not image:
+                logging.error(f'wall photo for art {art.id} was not uploaded')
                 continue
-            if wall_info['response']['count'] >= MAX_POSTPONED_POSTS:
-                await asyncio.sleep(30 * 60)
-                continue
-            image = asyncio.create_task(post_api.upload_image(art.url, group_id=group_id,
-                                                              server_method='photos.getWallUploadServer',
-                                                              save_method='photos.saveWallPhoto'))
-            postponed_posts_time = [i['date'] for i in wall_info['response']['items']]
-            # print(postponed_posts_time)
-            post_day = time.time() // (24 * h) * (24 * h) + 3 * h
-            post_iter = 0
-            while post_day + post_time_list[post_iter] in postponed_posts_time or \
-                    post_day + post_time_list[post_iter] < time.time():
-                post_iter += 1
-                if post_iter >= len(post_time_list):
-                    post_iter = 0
-                    post_day += 24 * h
-
-            # print(post_day + post_time_list[post_iter])
-            post_text = f"{tag_list}\n\n" \
-                        f"Источник: {group_link}"
-            # print('post day', time.localtime(post_day))
-            # print('post time', time.localtime(post_day+post_time_list[post_iter]))
-            post_info = await post_api.request_get('wall.post', {'owner_id': -group_id,
+            post_info = await self.api.request_get('wall.post', {'owner_id': -self.group_id,
                                                                  'from_group': 1,
                                                                  'message': post_text,
-                                                                 'attachments': await image,
-                                                                 'publish_date': post_day + post_time_list[post_iter],
-                                                                 'copyright': 'vk.com/' + art.source})
-            # print(post_info)
+                                                                 'attachments': image,
+                                                                 'publish_date': slot,
+                                                                 'copyright': 'vk.com/' + art.source},
+                                                   priority=vk_api.PRIORITY_BACKGROUND)
             if 'response' in post_info:
+                self.postponed.add(slot)
+                self.postponed_count += 1
                 art.accepted = 2
-                art.save()
+                await db_api.run(art.save)
             else:
                 logging.error(f'post_info {post_info}')
-        else:
-            admins = db_api.Admins.select()
-            for admin_id in admins:
-                last_message = await vk.request_get('messages.getHistory',
-                                                    {'count': 1,
-                                                     'user_id': admin_id})
-                last_message = last_message.get('response', {}).get('items', [])
-                if last_message and time.time() - last_message[0]['date'] > 3 * h:
-                    bot_message = {
-                        'peer_id': admin_id,
-                        'message': "Посты заканчиваютя...",
-                    }
-                    msg = await vk.msg_send(bot_message)
-        await asyncio.sleep(15 * 60)
+
+    async def notify_admins(self):
+        admins = await db_api.run(list, db_api.Admins.select())
+        for admin in admins:
+            last_message = await vk.request_get('messages.getHistory',
+                                                {'count': 1,
+                                                 'user_id': admin.user_id},
+                                                priority=vk_api.PRIORITY_BACKGROUND,
+                                                batch=True)
+            last_message = last_message.get('response', {}).get('items', [])
+            if last_message and time.time() - last_message[0]['date'] > 3 * HOUR:
+                bot_message = {
+                    'peer_id': admin.user_id,
+                    'message': "Посты заканчиваютя...",
+                }
+                await vk.msg_send(bot_message, priority=vk_api.PRIORITY_BACKGROUND)
+
+    async def run(self):
+        await self.start()
+        STAGER.start()
+        for art_id in await db_api.run(get_unstaged_arts, STAGER.max_queue):
+            STAGER.submit(art_id, art_id)
+        while True:
+            self.wake_event.clear()
+            try:
+                delay = await self.fill()
+            except Exception as error_msg:
+                logging.exception(f'wall scheduler: {error_msg}')
+                delay = 5 * 60
+            try:
+                await asyncio.wait_for(self.wake_event.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+
+SCHEDULER = WallScheduler()
+
+
+def get_unstaged_arts(limit):
+    arts = db_api.Art.select(db_api.Art.id)\
+        .where((db_api.Art.accepted == 1) & db_api.Art.wall_photo.is_null())\
+        .order_by(db_api.Art.add_time)\
+        .limit(limit)
+    return [art.id for art in arts]
+
+
+def get_wall_photos(art_ids):
+    if not art_ids:
+        return {}
+    arts = db_api.Art.select(db_api.Art.id, db_api.Art.wall_photo)\
+        .where(db_api.Art.id.in_(art_ids) & db_api.Art.wall_photo.is_null(False))
+    return {art.id: art.wall_photo for art in arts}
+
+
+async def stage_wall_photo(art_id):
+    # uploads the wall photo of an accepted art long before it is published
+    if art_id in STAGING:
+        return
+    STAGING.add(art_id)
+    try:
+        art = await db_api.run(db_api.Art.get_or_none, id=art_id)
+        if not art or art.accepted != 1 or art.wall_photo:
+            return
+        image = await SCHEDULER.upload(art)
+        if image:
+            await db_api.run(db_api.Art.update(wall_photo=image).where(db_api.Art.id == art_id).execute)
+    finally:
+        STAGING.discard(art_id)
+        if art_id in SCHEDULER.waiting:
+            SCHEDULER.waiting.discard(art_id)
+            SCHEDULER.wake()
+
+
+# arts whose wall photo is being uploaded, by the stager or by publish
+STAGING = set()
+STAGER = PeerWorkers(stage_wall_photo,
+                     workers=CONF.getint('VK', 'stage_workers', fallback=2),
+                     max_queue=CONF.getint('VK', 'stage_queue', fallback=200),
+                     label='wall photo of art {}')
+
+
+async def post_arts():
+    await SCHEDULER.run()
+
+
+def get_post_text(art, screen_name):
+    selected_tags = db_api.ArtTag.select().where(db_api.ArtTag.art == art)
+    tag_list = '\n'.join([f"#{t.tag.title.replace(' ', '_')}@{screen_name}" for t in selected_tags])
+    group_link = get_group_link(art.from_group.id, art.from_group.name)
+    return f"{tag_list}\n\n" \
+           f"Источник: {group_link}"
+
+
+async def load_payload(payload):
+    # buttons carry {"s": state id}, keyboards sent before that carry the breadcrumb list itself
+    if not isinstance(payload, dict) or not isinstance(payload.get('s'), str):
+        return payload
+    stack = NAVIGATION.get(payload['s'])
+    if stack is None:
+        data = await db_api.run(db_api.get_nav_state, payload['s'])
+        if data is None:
+            return payload
+        stack = NAVIGATION.load(payload['s'], data)
+    return stack
+
+
+async def save_navigation():
+    states = NAVIGATION.flush()
+    if states:
+        await db_api.run(db_api.save_nav_states, states)
+
+
+async def clear_navigation():
+    while True:
+        try:
+            deleted = await db_api.run(db_api.clear_nav_states)
+            logging.info(f'navigation states deleted: {deleted}')
+        except Exception as error_msg:
+            logging.exception(f'clear navigation: {error_msg}')
+        await asyncio.sleep(HOUR)
+
+
+async def notify_user(user, last_msg_time, last_online):
+    last_messages = await vk.request_get('messages.getHistory',
+                                         {'count': 10,
+                                          'peer_id': user.id,
+                                          'extended': 1},
+                                         priority=vk_api.PRIORITY_BACKGROUND,
+                                         batch=True)
+    conv_info = last_messages.get('response', {}).get('conversations', [{}])[0]
+    user_info = last_messages.get('response', {}).get('profiles', [{}])[0]
+    messages = last_messages.get('response', {}).get('items', [])
+    if not conv_info.get('can_write', {}).get('allowed') or len([m for m in messages if not m['out']]) < 3:
+        await db_api.run(db_api.set_last_message, user.id)
+        return
+    if user_info.get('online_info', {}).get('visible') and \
+            user_info.get('online_info', {}).get('last_seen', time.time()) < last_online:
+        return
+    if messages[0]['date'] > last_msg_time:
+        await db_api.run(db_api.set_last_message, user.id, messages[0]['date'])
+        return
+
+    payloads = [{}]
+    last_msg = [m for m in messages if 'keyboard' in m]
+    if last_msg:
+        for buttons_row in last_msg[0]['keyboard']['buttons']:
+            for button in buttons_row:
+                payload = await load_payload(json.loads(button['action']['payload']))
+                if isinstance(payload, list):
+                    payloads.append(payload)
+    payload = sorted(payloads, key=lambda x: len(x))[-1]
+    bot_message = BotMessage(
+        peer_id=user.id,
+        text=f"Приветик!\nНам очень нужна твоя помощь в поиске артов!\n"
+             f"Проверь пожалуйста группу художника, "
+             f"наверняка там появились новые классные артики!",
+        default_payload=payload,
+        save_menu=False
+    )
+    bot_message.keyboard.add_button(f"Найти новый арт", {'mid': 'add_image'},
+                                    row=1, color='primary')
+    bot_message.keyboard.navigation_buttons()
+    await vk.msg_send(bot_message.convert_to_vk(), priority=vk_api.PRIORITY_BACKGROUND)
+    await save_navigation()
+    await db_api.run(db_api.set_last_message, user.id)
 
 
 async def inactive_notification():
-    global LAST_MESSAGES
     while True:
-        arts_count = db_api.Art.select().where(db_api.Art.accepted == 1).count()
+        arts_count = await db_api.run(db_api.get_counter, 'art', 1)
         if arts_count >= 50:
-            await asyncio.sleep(60 * 60)
+            await asyncio.sleep(NOTIFY_INTERVAL)
             continue
         last_msg_time = time.time() - 2 * 24 * 60 * 60
         last_post_time = time.time() - 5 * 24 * 60 * 60
         last_online = time.time() - 15 * 60
-        users_not_allowed = [i for i in LAST_MESSAGES if LAST_MESSAGES[i] > last_post_time]
+        await db_api.run(db_api.clear_last_messages, last_post_time)
+        # an interrupted sweep goes on from the last finished chunk
+        checkpoint = await db_api.run(db_api.get_checkpoint, 'inactive_notification',
+                                      time.time() - NOTIFY_INTERVAL)
 
         user_arts = db_api.Art.select(db_api.Art.add_by)\
             .where((db_api.Art.add_time > last_post_time))
 
+        users_not_allowed = db_api.LastMessage.select(db_api.LastMessage.user)\
+            .where(db_api.LastMessage.time > last_post_time)
+
         users = db_api.User.select()\
             .where(db_api.User.id.not_in(user_arts) &
-                   db_api.User.id.not_in(users_not_allowed))
-
-        for user in users:
-            last_messages = await vk.request_get('messages.getHistory',
-                                                 {'count': 10,
-                                                  'peer_id': user.id,
-                                                  'extended': 1})
-            conv_info = last_messages.get('response', {}).get('conversations', [{}])[0]
-            user_info = last_messages.get('response', {}).get('profiles', [{}])[0]
-            messages = last_messages.get('response', {}).get('items', [])
-            if not conv_info.get('can_write', {}).get('allowed') or len([m for m in messages if not m['out']]) < 3:
-                LAST_MESSAGES[user_info['id']] = int(time.time())
-                continue
-            if user_info.get('online_info', {}).get('visible') and \
-                    user_info.get('online_info', {}).get('last_seen', time.time()) < last_online:
-                continue
-            if messages[0]['date'] > last_msg_time:
-                LAST_MESSAGES[user_info['id']] = messages[0]['date']
-                continue
-
-            payloads = [{}]
-            last_msg = [m for m in messages if 'keyboard' in m]
-            if last_msg:
-                for buttons_row in last_msg[0]['keyboard']['buttons']:
-                    for button in buttons_row:
-                        payloads.append(json.loads(button['action']['payload']))
-            payload = sorted(payloads, key=lambda x: len(x))[-1]
-            bot_message = BotMessage(
-                peer_id=user.id,
-                text=f"Приветик!\nНам очень нужна твоя помощь в поиске артов!\n"
-                     f"Проверь пожалуйста группу художника, "
-                     f"наверняка там появились новые классные артики!",
-                default_payload=payload,
-                save_menu=False
-            )
-            bot_message.keyboard.add_button(f"Найти новый арт", {'mid': 'add_image'},
-                                            row=1, color='primary')
-            bot_message.keyboard.navigation_buttons()
-            # await vk.msg_send(bot_message.convert_to_vk())
-            asyncio.create_task(vk.msg_send(bot_message.convert_to_vk()))
-        await asyncio.sleep(60 * 60)
+                   db_api.User.id.not_in(users_not_allowed) &
+                   (db_api.User.id > checkpoint))\
+            .order_by(db_api.User.id)
+
+        users = await db_api.run(list, users)
+        for start in range(0, len(users), NOTIFY_CHUNK):
+            # the whole chunk is in flight at once, so its getHistory calls share execute requests
+            chunk = users[start:start + NOTIFY_CHUNK]
+            results = await asyncio.gather(*[notify_user(user, last_msg_time, last_online) for user in chunk],
+                                           return_exceptions=True)
+            for user, result in zip(chunk, results):
+                if isinstance(result, Exception):
+                    logging.error(f'inactive notification for {user.id}: {result!r}')
+            await db_api.run(db_api.set_checkpoint, 'inactive_notification', chunk[-1].id)
+        await db_api.run(db_api.delete_checkpoint, 'inactive_notification')
+        await asyncio.sleep(NOTIFY_INTERVAL)
+
+
+def get_cursor(payload):
+    # the page a paged menu was opened on, see db_api.get_page
+    if payload.get('before') is not None:
+        return {'before': payload['before']}
+    if payload.get('after') is not None:
+        return {'after': payload['after']}
+    return {}
+
+
+def page_buttons(keyboard, payload, prev_page, next_page):
+    if prev_page:
+        keyboard.add_button('<-', dict(payload, before=prev_page), row=9)
+    if next_page:
+        keyboard.add_button('->', dict(payload, after=next_page), row=9)
 
 
 def get_group_link(group_id, group_name):
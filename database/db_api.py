@@ -1,14 +1,45 @@
 import peewee
 import main
+import asyncio
+import functools
+import json
 import logging
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils import metrics
+
+
+WRITE_TABLE = re.compile(r'^(?:INSERT(?: OR \w+)? INTO|REPLACE INTO|UPDATE|DELETE FROM) "(\w+)"')
+# called with the table name after every write, e.g. to drop cached menus
+WRITE_LISTENERS = list()
+
+
+class Database(peewee.SqliteDatabase):
+    def execute_sql(self, sql, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().execute_sql(sql, *args, **kwargs)
+        finally:
+            metrics.DB_QUERIES.observe(time.perf_counter() - start, statement=sql.split(None, 1)[0].upper())
+            table = WRITE_TABLE.match(sql) if WRITE_LISTENERS else None
+            if table:
+                for listener in WRITE_LISTENERS:
+                    listener(table.group(1))
 
 
 db_filename = main.CONF.get('VK', 'db_file', fallback='')
-db = peewee.SqliteDatabase(db_filename, pragmas={'journal_mode': 'wal',
-                                                 'cache_size': 64,
-                                                 'foreign_keys': 1,
-                                                 'ignore_check_constraints': 0,
-                                                 'synchronous': 0})
+UPLOAD_CACHE_TTL = main.CONF.getint('VK', 'upload_cache_ttl', fallback=30 * 24 * 60 * 60)
+NAV_STATE_TTL = main.CONF.getint('VK', 'nav_state_ttl', fallback=90 * 24 * 60 * 60)
+NAV_STATE_MAX = main.CONF.getint('VK', 'nav_state_max', fallback=1000000)
+db = Database(db_filename, pragmas={'journal_mode': 'wal',
+                                    'cache_size': 64,
+                                    'foreign_keys': 1,
+                                    'ignore_check_constraints': 0,
+                                    'synchronous': 0})
+# peewee keeps a connection per thread, so the pool threads reuse their own connections
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=main.CONF.getint('VK', 'db_workers', fallback=4),
+                                 thread_name_prefix='db')
 
 
 class User(peewee.Model):
@@ -44,6 +75,14 @@ class Group(peewee.Model):
 
     class Meta:
         database = db
+        indexes = (
+            (('accepted', 'last_post'), False),
+            (('accepted', 'last_scan'), False),
+            (('accepted', 'last_update'), False),
+            (('add_by', 'accepted'), False),
+            (('accepted', 'name'), False),
+            (('accepted', 'subs'), False),
+        )
 
 
 class Price(peewee.Model):
@@ -57,6 +96,17 @@ class Price(peewee.Model):
 
     class Meta:
         database = db
+        indexes = (
+            (('accepted', 'last_scan'), False),
+        )
+
+
+# the order of the price list: by the sum, refused prices last. written the same way
+# as the index expression, literals included, otherwise sqlite does not use the index
+PRICE_SUM = '("accepted" < 0) * 1000000000 + "head" + "half" + "full"'
+PRICE_ORDER = peewee.SQL(PRICE_SUM)
+PRICE_ORDER_INDEX = f'CREATE INDEX IF NOT EXISTS "price_order" ON "price" ({PRICE_SUM})'
+Price.add_index(peewee.SQL(PRICE_ORDER_INDEX))
 
 
 class Art(peewee.Model):
@@ -69,9 +119,18 @@ class Art(peewee.Model):
     accepted = peewee.IntegerField(default=0)
     add_time = peewee.IntegerField(default=0)
     message_id = peewee.IntegerField(default=0)
+    phash = peewee.CharField(null=True)
+    wall_photo = peewee.CharField(null=True)
 
     class Meta:
         database = db
+        indexes = (
+            (('accepted', 'add_time'), False),
+            (('add_time', 'add_by'), False),
+            (('add_by', 'accepted'), False),
+            (('add_by', 'add_time'), False),
+            (('from_group', 'accepted', 'add_time'), False),
+        )
 
 
 class Tag(peewee.Model):
@@ -81,6 +140,9 @@ class Tag(peewee.Model):
 
     class Meta:
         database = db
+        indexes = (
+            (('title',), False),
+        )
 
 
 class ArtTag(peewee.Model):
@@ -92,6 +154,78 @@ class ArtTag(peewee.Model):
         primary_key = peewee.CompositeKey('art', 'tag')
 
 
+class Counter(peewee.Model):
+    # row counts of art/group per accepted status, user 0 holds the totals.
+    # kept up to date by the triggers from create_counters()
+    kind = peewee.CharField()
+    user = peewee.IntegerField(default=0)
+    accepted = peewee.IntegerField()
+    value = peewee.IntegerField(default=0)
+
+    class Meta:
+        database = db
+        primary_key = peewee.CompositeKey('kind', 'user', 'accepted')
+
+
+class Event(peewee.Model):
+    id = peewee.CharField(primary_key=True)
+    add_time = peewee.IntegerField(default=0, index=True)
+
+    class Meta:
+        database = db
+
+
+class LastMessage(peewee.Model):
+    # time of the last message from a user, inactive_notification skips recently active users
+    user = peewee.IntegerField(primary_key=True)
+    time = peewee.IntegerField(default=0, index=True)
+
+    class Meta:
+        database = db
+
+
+class Checkpoint(peewee.Model):
+    # progress of a long background job, lets it resume after a restart
+    name = peewee.CharField(primary_key=True)
+    value = peewee.IntegerField(default=0)
+    add_time = peewee.IntegerField(default=0)
+
+    class Meta:
+        database = db
+
+
+class NavState(peewee.Model):
+    # menu breadcrumbs behind the state ids in button payloads, see utils.navigation
+    id = peewee.CharField(primary_key=True)
+    payload = peewee.TextField()
+    add_time = peewee.IntegerField(default=0, index=True)
+
+    class Meta:
+        database = db
+
+
+class PendingMessage(peewee.Model):
+    # messages waiting for a button press, see utils.pending
+    peer_id = peewee.IntegerField(index=True)
+    add_time = peewee.FloatField(default=0, index=True)
+    message = peewee.TextField()
+
+    class Meta:
+        database = db
+
+
+class UploadCache(peewee.Model):
+    # vk attachment made from the image url for the given upload target
+    url = peewee.CharField()
+    target = peewee.CharField()
+    attachment = peewee.CharField()
+    add_time = peewee.IntegerField(default=0, index=True)
+
+    class Meta:
+        database = db
+        primary_key = peewee.CompositeKey('url', 'target')
+
+
 class Migrations(peewee.Model):
     id = peewee.IntegerField(primary_key=True)
 
@@ -99,16 +233,253 @@ class Migrations(peewee.Model):
         database = db
 
 
+COUNTER_TABLES = {'art': 'art', 'group': '"group"'}
+COUNTER_TRIGGERS = '''
+CREATE TRIGGER IF NOT EXISTS {kind}_counter_insert AFTER INSERT ON {table}
+BEGIN
+    INSERT INTO counter (kind, "user", accepted, value)
+        VALUES ('{kind}', NEW.add_by_id, NEW.accepted, 1), ('{kind}', 0, NEW.accepted, 1)
+        ON CONFLICT (kind, "user", accepted) DO UPDATE SET value = value + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS {kind}_counter_delete AFTER DELETE ON {table}
+BEGIN
+    UPDATE counter SET value = value - 1
+        WHERE kind = '{kind}' AND "user" IN (0, OLD.add_by_id) AND accepted = OLD.accepted;
+END;
+CREATE TRIGGER IF NOT EXISTS {kind}_counter_update AFTER UPDATE OF accepted, add_by_id ON {table}
+    WHEN OLD.accepted != NEW.accepted OR OLD.add_by_id != NEW.add_by_id
+BEGIN
+    UPDATE counter SET value = value - 1
+        WHERE kind = '{kind}' AND "user" IN (0, OLD.add_by_id) AND accepted = OLD.accepted;
+    INSERT INTO counter (kind, "user", accepted, value)
+        VALUES ('{kind}', NEW.add_by_id, NEW.accepted, 1), ('{kind}', 0, NEW.accepted, 1)
+        ON CONFLICT (kind, "user", accepted) DO UPDATE SET value = value + 1;
+END;
+'''
+
+
+def create_counters(database):
+    for kind, table in COUNTER_TABLES.items():
+        for trigger in COUNTER_TRIGGERS.format(kind=kind, table=table).split('END;')[:-1]:
+            database.execute_sql(trigger + 'END;')
+    # fill the counters from the current tables
+    with database.atomic():
+        database.execute_sql('DELETE FROM counter')
+        for kind, table in COUNTER_TABLES.items():
+            database.execute_sql(f'''INSERT INTO counter (kind, "user", accepted, value)
+                                    SELECT '{kind}', add_by_id, accepted, COUNT(*) FROM {table}
+                                    GROUP BY add_by_id, accepted''')
+            database.execute_sql(f'''INSERT INTO counter (kind, "user", accepted, value)
+                                    SELECT '{kind}', 0, accepted, COUNT(*) FROM {table}
+                                    GROUP BY accepted''')
+
+
+def get_counter(kind, accepted, user=0):
+    counter = Counter.get_or_none(kind=kind, user=user, accepted=accepted)
+    return counter.value if counter else 0
+
+
+def get_counters(kind, user=0):
+    counters = Counter.select().where((Counter.kind == kind) & (Counter.user == user))
+    return {c.accepted: c.value for c in counters}
+
+
+def page_query(query, keys, after=None, before=None, limit=16, desc=False):
+    # the query get_page runs, one row more than the page to know if there is another one
+    backward = before is not None
+    cursor = before if backward else after
+    query = query.select_extend(*[key.alias(f'page_key{i}') for i, key in enumerate(keys)])
+    if cursor is not None:
+        # the bound on the first key is redundant, but sqlite seeks an expression index
+        # only by a plain comparison, not by a row value
+        if backward != desc:
+            query = query.where((peewee.Tuple(*keys) < peewee.Tuple(*cursor)) & (keys[0] <= cursor[0]))
+        else:
+            query = query.where((peewee.Tuple(*keys) > peewee.Tuple(*cursor)) & (keys[0] >= cursor[0]))
+    if backward != desc:
+        query = query.order_by(*[key.desc() for key in keys])
+    else:
+        query = query.order_by(*keys)
+    return query.limit(limit + 1)
+
+
+def get_page(query, keys, after=None, before=None, limit=16, desc=False):
+    # keyset pagination: seeks past the cursor instead of skipping rows with OFFSET.
+    # keys must make the order unique (end with the primary key) and be covered by an index.
+    # returns the rows and the cursors of the previous and next pages, None when there is none
+    backward = before is not None
+    cursor = before if backward else after
+    rows = list(page_query(query, keys, after, before, limit, desc))
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+    cursors = [[getattr(row, f'page_key{i}') for i in range(len(keys))] for row in rows]
+    has_prev = more if backward else cursor is not None
+    has_next = True if backward else more
+    prev_page = cursors[0] if rows and has_prev else None
+    next_page = cursors[-1] if rows and has_next else None
+    return rows, prev_page, next_page
+
+
+def save_event(event_id):
+    Event.insert(id=event_id, add_time=int(time.time())).on_conflict_ignore().execute()
+
+
+def prune_events(min_time):
+    return Event.delete().where(Event.add_time < min_time).execute()
+
+
+def load_events(min_time):
+    prune_events(min_time)
+    return [(e.id, e.add_time) for e in Event.select().where(Event.add_time >= min_time)]
+
+
+def set_last_message(user_id, message_time=None):
+    LastMessage.replace(user=user_id, time=int(message_time if message_time else time.time())).execute()
+
+
+def clear_last_messages(min_time):
+    return LastMessage.delete().where(LastMessage.time <= min_time).execute()
+
+
+def get_checkpoint(name, min_time):
+    checkpoint = Checkpoint.get_or_none((Checkpoint.name == name) & (Checkpoint.add_time > min_time))
+    return checkpoint.value if checkpoint else 0
+
+
+def set_checkpoint(name, value):
+    Checkpoint.replace(name=name, value=value, add_time=int(time.time())).execute()
+
+
+def delete_checkpoint(name):
+    Checkpoint.delete().where(Checkpoint.name == name).execute()
+
+
+def get_nav_state(state_id):
+    state = NavState.get_or_none(id=state_id)
+    return state.payload if state else None
+
+
+def save_nav_states(states):
+    now = int(time.time())
+    with db.atomic():
+        NavState.insert_many([(state_id, payload, now) for state_id, payload in states],
+                             fields=[NavState.id, NavState.payload, NavState.add_time])\
+            .on_conflict(conflict_target=[NavState.id], preserve=[NavState.add_time]).execute()
+
+
+def clear_nav_states():
+    # drops expired states, then the oldest ones over NAV_STATE_MAX
+    deleted = NavState.delete().where(NavState.add_time <= time.time() - NAV_STATE_TTL).execute()
+    oldest = NavState.select(NavState.add_time)\
+        .order_by(NavState.add_time.desc())\
+        .offset(NAV_STATE_MAX)\
+        .limit(1)\
+        .scalar()
+    if oldest is not None:
+        deleted += NavState.delete().where(NavState.add_time <= oldest).execute()
+    return deleted
+
+
+def save_pending(peer_id, message, per_peer=None):
+    # keeps the same newest `per_peer` messages as PendingMessages does
+    with db.atomic():
+        PendingMessage.create(peer_id=peer_id, add_time=time.time(), message=json.dumps(message, ensure_ascii=False))
+        if per_peer:
+            newest = PendingMessage.select(PendingMessage.id)\
+                .where(PendingMessage.peer_id == peer_id)\
+                .order_by(PendingMessage.add_time.desc(), PendingMessage.id.desc())\
+                .limit(per_peer)
+            PendingMessage.delete()\
+                .where((PendingMessage.peer_id == peer_id) & PendingMessage.id.not_in(newest))\
+                .execute()
+
+
+def delete_pending(peer_id):
+    PendingMessage.delete().where(PendingMessage.peer_id == peer_id).execute()
+
+
+def prune_pending(min_time, max_messages=None):
+    # drops expired messages, then the oldest ones over `max_messages`
+    deleted = PendingMessage.delete().where(PendingMessage.add_time < min_time).execute()
+    if max_messages:
+        oldest = PendingMessage.select(PendingMessage.add_time)\
+            .order_by(PendingMessage.add_time.desc())\
+            .offset(max_messages)\
+            .limit(1)\
+            .scalar()
+        if oldest is not None:
+            deleted += PendingMessage.delete().where(PendingMessage.add_time <= oldest).execute()
+    return deleted
+
+
+def load_pending(min_time, max_messages=None):
+    prune_pending(min_time, max_messages)
+    return [(m.peer_id, m.add_time, json.loads(m.message))
+            for m in PendingMessage.select().where(PendingMessage.add_time >= min_time)]
+
+
+def get_cached_upload(url, target):
+    cached = UploadCache.get_or_none((UploadCache.url == url) &
+                                     (UploadCache.target == target) &
+                                     (UploadCache.add_time > time.time() - UPLOAD_CACHE_TTL))
+    return cached.attachment if cached else None
+
+
+def save_cached_upload(url, target, attachment):
+    UploadCache.replace(url=url, target=target, attachment=attachment, add_time=int(time.time())).execute()
+
+
+def clear_upload_cache():
+    return UploadCache.delete().where(UploadCache.add_time <= time.time() - UPLOAD_CACHE_TTL).execute()
+
+
+def get_art_hashes():
+    arts = Art.select(Art.id, Art.phash).where(Art.phash.is_null(False)).tuples()
+    return [(int(image_hash, 16), art_id) for art_id, image_hash in arts]
+
+
+async def run(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(DB_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+
+def threaded(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run(func, *args, **kwargs)
+    return wrapper
+
+
 def init_db():
     if not db.get_tables():
-        db.create_tables([User, Group, Admins, Migrations, Art, Tag, ArtTag, Price])
+        db.create_tables([User, Group, Admins, Migrations, Art, Tag, ArtTag, Price, Counter, Event,
+                          UploadCache, PendingMessage, LastMessage,
+                          Checkpoint, NavState])
+        create_counters(db)
         Migrations.create(id=1)
         Migrations.create(id=2)
         Migrations.create(id=3)
+        Migrations.create(id=4)
+        Migrations.create(id=5)
+        Migrations.create(id=6)
+        Migrations.create(id=7)
+        Migrations.create(id=8)
+        Migrations.create(id=9)
+        Migrations.create(id=10)
+        Migrations.create(id=11)
+        Migrations.create(id=12)
+        Migrations.create(id=13)
+        Migrations.create(id=14)
         return True
     return False
 
 
+def is_admin(user_id):
+    return Admins.get_or_none(Admins.user == user_id) is not None
+
+
 def update_admins(admin_list):
     for admin in admin_list:
         if admin['role'] in ['creator', 'administrator']:
@@ -127,23 +498,90 @@ def update_db():
                                                              'ignore_check_constraints': 0,
                                                              'synchronous': 0})
     migrator = playhouse_migrate.SqliteMigrator(db_migrate)
-    if not Migrations.get_or_none(1):
+    if not Migrations.get_or_none(id=1):
         logging.info(f'migration 1')
         playhouse_migrate.migrate(
             migrator.add_column('Group', 'accepted', peewee.BooleanField(default=False)),
         )
         Migrations.create(id=1)
-    if not Migrations.get_or_none(2):
+    if not Migrations.get_or_none(id=2):
         logging.info(f'migration 2')
         playhouse_migrate.migrate(
             migrator.add_column('Group', 'last_scan', Group.last_scan),
             migrator.add_column('Art', 'message_id', Art.message_id),
         )
         Migrations.create(id=2)
-    if not Migrations.get_or_none(3):
+    if not Migrations.get_or_none(id=3):
         logging.info(f'migration 3')
         db.create_tables([Price])
         Migrations.create(id=3)
+    if not Migrations.get_or_none(id=4):
+        logging.info(f'migration 4')
+        playhouse_migrate.migrate(
+            migrator.add_index('art', ('accepted', 'add_time'), False),
+            migrator.add_index('art', ('add_time', 'add_by_id'), False),
+            migrator.add_index('art', ('add_by_id', 'accepted'), False),
+            migrator.add_index('art', ('add_by_id', 'add_time'), False),
+            migrator.add_index('art', ('from_group_id', 'accepted', 'add_time'), False),
+            migrator.add_index('group', ('accepted', 'last_post'), False),
+            migrator.add_index('group', ('accepted', 'last_scan'), False),
+            migrator.add_index('group', ('accepted', 'last_update'), False),
+            migrator.add_index('group', ('add_by_id', 'accepted'), False),
+            migrator.add_index('price', ('accepted', 'last_scan'), False),
+        )
+        db_migrate.execute_sql('ANALYZE')
+        Migrations.create(id=4)
+    if not Migrations.get_or_none(id=5):
+        logging.info(f'migration 5')
+        db.create_tables([Counter])
+        create_counters(db)
+        Migrations.create(id=5)
+    if not Migrations.get_or_none(id=6):
+        logging.info(f'migration 6')
+        db.create_tables([Event])
+        Migrations.create(id=6)
+    if not Migrations.get_or_none(id=7):
+        logging.info(f'migration 7')
+        db.create_tables([UploadCache])
+        Migrations.create(id=7)
+    if not Migrations.get_or_none(id=8):
+        logging.info(f'migration 8')
+        playhouse_migrate.migrate(
+            migrator.add_column('art', 'phash', Art.phash),
+        )
+        Migrations.create(id=8)
+    if not Migrations.get_or_none(id=9):
+        logging.info(f'migration 9')
+        db.create_tables([PendingMessage])
+        Migrations.create(id=9)
+    if not Migrations.get_or_none(id=10):
+        logging.info(f'migration 10')
+        db.create_tables([LastMessage])
+        Migrations.create(id=10)
+    if not Migrations.get_or_none(id=11):
+        logging.info(f'migration 11')
+        db.create_tables([Checkpoint])
+        Migrations.create(id=11)
+    if not Migrations.get_or_none(id=12):
+        logging.info(f'migration 12')
+        playhouse_migrate.migrate(
+            migrator.add_column('art', 'wall_photo', Art.wall_photo),
+        )
+        Migrations.create(id=12)
+    if not Migrations.get_or_none(id=13):
+        logging.info(f'migration 13')
+        db.create_tables([NavState])
+        Migrations.create(id=13)
+    if not Migrations.get_or_none(id=14):
+        logging.info(f'migration 14')
+        playhouse_migrate.migrate(
+            migrator.add_index('group', ('accepted', 'name'), False),
+            migrator.add_index('group', ('accepted', 'subs'), False),
+            migrator.add_index('tag', ('title',), False),
+        )
+        db_migrate.execute_sql(PRICE_ORDER_INDEX)
+        db_migrate.execute_sql('ANALYZE')
+        Migrations.create(id=14)
     #         playhouse_migrate.migrate(
     #             migrator.add_column('RpProfile', 'show_link', RpProfile.show_link),
     #             # migrator.rename_column('ProfileSettingList', 'item_id', 'item'),
@@ -0,0 +1,167 @@
+import sys
+import time
+import peewee
+from bot_menu import system
+from database import db_api
+
+
+def page(query, keys, cursor=None, desc=False):
+    # the query db_api.get_page runs for the page after `cursor`
+    return db_api.page_query(query, keys, after=cursor, limit=system.BTN_PER_PAGE, desc=desc)
+
+
+def get_queries():
+    # the queries bot_menu.system runs, with placeholder values.
+    # the third item is True when reading the whole table is expected
+    user = 0
+    now = int(time.time())
+    accepted_groups = db_api.Group.select().where(db_api.Group.accepted == 1)
+    return [
+        ('counters', db_api.Counter.select()
+            .where((db_api.Counter.kind == 'art') & (db_api.Counter.user == user)), False),
+        ('counter', db_api.Counter.select()
+            .where((db_api.Counter.kind == 'art') & (db_api.Counter.user == user) &
+                   (db_api.Counter.accepted == 1)), False),
+        ('main: weekly arts', db_api.Art.select()
+            .where((db_api.Art.add_by == user) & (db_api.Art.add_time > now)), False),
+        ('confirm_group_list', db_api.Group.select()
+            .where(db_api.Group.accepted == 0)
+            .order_by(db_api.Group.last_update)
+            .limit(system.BTN_PER_PAGE), False),
+        ('confirm_group: images', db_api.Art.select()
+            .where(db_api.Art.from_group == 0)
+            .limit(10), False),
+        ('confirm_art_list', db_api.Art.select()
+            .where(db_api.Art.accepted == 0)
+            .limit(system.BTN_PER_PAGE), False),
+        ('confirm_art: group arts', db_api.Art.select()
+            .where((db_api.Art.from_group == 0) & (db_api.Art.accepted > 0))
+            .order_by(db_api.Art.add_time.desc())
+            .limit(10), False),
+        ('confirm_art: last posted', db_api.Art.select()
+            .where(db_api.Art.accepted == 2)
+            .order_by(db_api.Art.add_time.desc())
+            .limit(1), False),
+        ('auto_add_group', db_api.Group.select()
+            .where(db_api.Group.accepted > 0)
+            .order_by(db_api.Group.last_scan)
+            .limit(10), False),
+        ('view_group_list: by update', page(accepted_groups, (db_api.Group.last_update, db_api.Group.id),
+                                            desc=True), False),
+        ('view_group_list: by update, next', page(accepted_groups, (db_api.Group.last_update, db_api.Group.id),
+                                                  (now, 0), True), False),
+        ('view_group_list: by name, next', page(accepted_groups, (db_api.Group.name, db_api.Group.id),
+                                                ('', 0)), False),
+        ('view_group_list: by subs, next', page(accepted_groups, (db_api.Group.subs, db_api.Group.id),
+                                                (0, 0)), False),
+        ('view_group_list: by price, next', page(db_api.Price.select(), (db_api.PRICE_ORDER, db_api.Price.group),
+                                                 (0, 0)), False),
+        ('my_group, next', page(db_api.Group.select()
+                                .where((db_api.Group.accepted == 0) & (db_api.Group.add_by == user)),
+                                (db_api.Group.id,), (0,)), False),
+        ('my_art, next', page(db_api.Art.select()
+                              .where((db_api.Art.accepted == 0) & (db_api.Art.add_by == user)),
+                              (db_api.Art.id,), (0,)), False),
+        ('tag list, next', page(db_api.Tag.select(), (db_api.Tag.title, db_api.Tag.id), ('', 0)), False),
+        ('view_group: images', db_api.Art.select()
+            .where((db_api.Art.from_group == 0) & (db_api.Art.accepted.in_([-2, 1, 2])))
+            .order_by(db_api.Art.add_time.desc())
+            .limit(10), False),
+        ('add_image', db_api.Group.select()
+            .where((db_api.Group.accepted == 1) &
+                   (db_api.Group.last_post < now) &
+                   (db_api.Group.likes < system.MAX_GROUP_LIKES) &
+                   db_api.Group.id.not_in(db_api.Art.select(db_api.Art.from_group)
+                                          .where(db_api.Art.accepted.in_([0, 1]))))
+            .order_by(db_api.Group.last_post)
+            .limit(50), False),
+        ('art_tags: selected', db_api.ArtTag.select().where(db_api.ArtTag.art == 0), False),
+        ('update_price', db_api.Group.select()
+            .where(db_api.Group.id.not_in(db_api.Price.select(db_api.Price.group)
+                                          .where((db_api.Price.last_scan > now) &
+                                                 db_api.Price.accepted.in_([-2, 0, 1]))) &
+                   (db_api.Group.accepted > 0))
+            .limit(50), False),
+        # ranks every user, reading the whole user table is expected
+        ('users_top: arts', db_api.User
+            .select(db_api.User, peewee.fn.COUNT(db_api.Art.id).alias('count'))
+            .join(db_api.Art, peewee.JOIN.LEFT_OUTER,
+                  on=((db_api.Art.add_by == db_api.User.id) & db_api.Art.accepted.in_([1, 2])))
+            .group_by(db_api.User)
+            .order_by(peewee.fn.COUNT(db_api.Art.id).desc())
+            .limit(10), True),
+        ('users_top: groups', db_api.User
+            .select(db_api.User, peewee.fn.COUNT(db_api.Group.id).alias('count'))
+            .join(db_api.Group, peewee.JOIN.LEFT_OUTER,
+                  on=((db_api.Group.add_by == db_api.User.id) & db_api.Group.accepted.in_([1])))
+            .group_by(db_api.User)
+            .order_by(peewee.fn.COUNT(db_api.Group.id).desc())
+            .limit(10), True),
+        ('wall scheduler: arts to post', db_api.Art.select()
+            .where((db_api.Art.accepted == 1) & (db_api.Art.add_time < now))
+            .order_by(db_api.Art.add_time)
+            .limit(system.MAX_POSTPONED_POSTS), False),
+        ('wall scheduler: next art', db_api.Art.select(peewee.fn.MIN(db_api.Art.add_time))
+            .where(db_api.Art.accepted == 1), False),
+        ('get_unstaged_arts', db_api.Art.select(db_api.Art.id)
+            .where((db_api.Art.accepted == 1) & db_api.Art.wall_photo.is_null())
+            .order_by(db_api.Art.add_time)
+            .limit(10), False),
+        ('get_wall_photos', db_api.Art.select(db_api.Art.id, db_api.Art.wall_photo)
+            .where(db_api.Art.id.in_([1, 2]) & db_api.Art.wall_photo.is_null(False)), False),
+        # loads every hash into the duplicate index at startup
+        ('get_art_hashes', db_api.Art.select(db_api.Art.id, db_api.Art.phash)
+            .where(db_api.Art.phash.is_null(False)), True),
+        ('inactive_notification: candidates', db_api.User.select()
+            .where(db_api.User.id.not_in(db_api.Art.select(db_api.Art.add_by)
+                                         .where(db_api.Art.add_time > now)) &
+                   db_api.User.id.not_in(db_api.LastMessage.select(db_api.LastMessage.user)
+                                         .where(db_api.LastMessage.time > now)) &
+                   (db_api.User.id > user))
+            .order_by(db_api.User.id), False),
+        ('clear_nav_states: oldest kept', db_api.NavState.select(db_api.NavState.add_time)
+            .order_by(db_api.NavState.add_time.desc())
+            .offset(db_api.NAV_STATE_MAX)
+            .limit(1), False),
+        ('prune_pending: oldest kept', db_api.PendingMessage.select(db_api.PendingMessage.add_time)
+            .order_by(db_api.PendingMessage.add_time.desc())
+            .offset(1000)
+            .limit(1), False),
+    ]
+
+
+def explain(query):
+    sql, params = query.sql()
+    cursor = db_api.db.execute_sql('EXPLAIN QUERY PLAN ' + sql, params)
+    return [row[-1] for row in cursor.fetchall()]
+
+
+def is_full_scan(detail):
+    # "SCAN t1" reads the whole table, "SCAN t1 USING INDEX ..." walks an index in order
+    return detail.startswith('SCAN ') and 'INDEX' not in detail
+
+
+def check_queries():
+    problems = list()
+    for name, query, scan_expected in get_queries():
+        plan = explain(query)
+        scans = [detail for detail in plan if is_full_scan(detail)]
+        if scans and scan_expected:
+            status = 'scan'
+        elif scans:
+            status = 'FULL SCAN'
+        else:
+            status = 'ok'
+        print(f'{status:<10} {name}')
+        for detail in plan:
+            print(f'           {detail}')
+        if scans and not scan_expected:
+            problems.append(name)
+    return problems
+
+
+if __name__ == "__main__":
+    if not db_api.init_db():
+        db_api.update_db()
+    if check_queries():
+        sys.exit(1)
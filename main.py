@@ -4,25 +4,35 @@ import configparser
 import time
 import json
 from aiohttp import web
+from api import vk_api
 from api.vk_api import VkApi
 from bot_menu import system
+from utils.dedup import EventCache
+from utils.pending import PendingMessages
+from utils import log
+from utils import metrics
+from utils.workers import PeerWorkers
 
 
 CONF = configparser.ConfigParser()
 CONF.read('bot_settings.inf', encoding='utf-8')
 routes = web.RouteTableDef()
-vk = VkApi(CONF.get('VK', 'token', fallback=''), '5.103')
-logging.basicConfig(
-    format='%(filename)-25s[LINE:%(lineno)4d]# %(levelname)-8s [%(asctime)s]  %(message)s',
-    level=logging.DEBUG,
-    datefmt='%m-%d %H:%M',
-    handlers=[logging.FileHandler('log/bot.log', 'w', 'utf-8')]
-)
-console = logging.StreamHandler()
-console.setLevel(logging.INFO)
-formatter = logging.Formatter('%(name)-15s: %(levelname)-8s %(message)s')
-console.setFormatter(formatter)
-logging.getLogger('').addHandler(console)
+vk = VkApi(CONF.get('VK', 'token', fallback=''), '5.103',
+           connections_limit=CONF.getint('HTTP', 'connections_limit', fallback=100),
+           connections_per_host=CONF.getint('HTTP', 'connections_per_host', fallback=30),
+           keepalive_timeout=CONF.getint('HTTP', 'keepalive_timeout', fallback=30),
+           dns_cache_ttl=CONF.getint('HTTP', 'dns_cache_ttl', fallback=300),
+           request_timeout=CONF.getint('HTTP', 'request_timeout', fallback=60),
+           rate_limit=CONF.getint('VK', 'rate_limit', fallback=20))
+vk_api.UPLOADS.configure(max_uploads=CONF.getint('HTTP', 'max_uploads', fallback=4),
+                         max_per_host=CONF.getint('HTTP', 'uploads_per_host', fallback=2))
+log.setup(CONF.get('LOG', 'file', fallback='log/bot.log'),
+          level=CONF.get('LOG', 'level', fallback='DEBUG').upper(),
+          console_level=CONF.get('LOG', 'console_level', fallback='INFO').upper(),
+          json_format=CONF.getboolean('LOG', 'json', fallback=True),
+          max_bytes=CONF.getint('LOG', 'max_bytes', fallback=10 * 2 ** 20),
+          backup_count=CONF.getint('LOG', 'backup_count', fallback=5),
+          debug_sample=CONF.getfloat('LOG', 'debug_sample', fallback=1.0))
 
 
 class UserMessage:
@@ -36,7 +46,20 @@ class UserMessage:
         self.unprocessed_messages = []
 
 
-TMP_MESSAGES = dict()
+PENDING = PendingMessages(per_peer=CONF.getint('VK', 'pending_per_peer', fallback=20),
+                          max_messages=CONF.getint('VK', 'pending_max', fallback=5000),
+                          ttl=CONF.getint('VK', 'pending_ttl', fallback=60 * 60))
+PERSIST_PENDING = CONF.getboolean('VK', 'persist_pending', fallback=False)
+REPLY_DEADLINE = CONF.getint('VK', 'reply_deadline', fallback=30)
+EVENTS = EventCache(max_size=CONF.getint('VK', 'events_cache_size', fallback=10000),
+                    ttl=CONF.getint('VK', 'events_ttl', fallback=60 * 60))
+PERSIST_EVENTS = CONF.getboolean('VK', 'persist_events', fallback=True)
+PRUNE_INTERVAL = CONF.getint('VK', 'prune_interval', fallback=10 * 60)
+BACKGROUND_TASKS = set()
+# long running jobs of bot_menu.system, started with the web app
+JOBS = list()
+LATENCY = metrics.LatencyWindow(CONF.getint('VK', 'latency_samples', fallback=4096))
+LATENCY_WINDOWS = ((60, '1 min'), (5 * 60, '5 min'), (60 * 60, '1 hour'))
 
 
 def timer(timers, title):
@@ -44,6 +67,14 @@ def timer(timers, title):
     timers['prew_timer'] = time.time()
 
 
+def record_timers(timers, menu):
+    # payloads come from users, unknown menus share one label
+    mid = menu if menu in system.ROUTES else 'unknown' if menu else 'none'
+    for stage, seconds in timers.items():
+        if stage != 'prew_timer':
+            metrics.STAGE_TIME.observe(seconds, stage=stage, mid=mid)
+
+
 async def vk_analyze(params):
     timers = {'prew_timer': time.time()}
     from database import db_api
@@ -56,48 +87,61 @@ async def vk_analyze(params):
         payload=json.loads(params['payload']) if params.get('payload') else None
     )
     timer(timers, 'input_message')
+    last_message = asyncio.create_task(db_api.run(db_api.set_last_message, message.peer_id))
+    BACKGROUND_TASKS.add(last_message)
+    last_message.add_done_callback(BACKGROUND_TASKS.discard)
+    message.payload = await system.load_payload(message.payload)
     msg_read = asyncio.create_task(vk.msg_read(message.peer_id))
     if params.get('is_cropped'):
         new_params = await vk.msg_get(params['id'])
         message.attachments = new_params.get('attachments', [])
 
-    if not db_api.User.get_or_none(id=message.peer_id):
-        menu = getattr(system.Functions(), 'new_user')
+    if message.payload is not None and \
+            (not isinstance(message.payload, list) or not all(isinstance(p, dict) for p in message.payload)):
+        # e.g. {"command": "start"} from the vk "start" button
+        message.payload = [{'mid': 'main'}]
+
+    if not await db_api.run(db_api.User.get_or_none, id=message.peer_id):
+        menu = 'new_user'
 
     elif message.payload:
-        if TMP_MESSAGES.get(message.peer_id):
-            message.unprocessed_messages = TMP_MESSAGES[message.peer_id]
-            TMP_MESSAGES.pop(message.peer_id)
-        menu = getattr(system.Functions(), message.payload[-1].get('mid', 'no_menu'), 'no_menu')
+        message.unprocessed_messages = [UserMessage(message.peer_id, **m) for m in PENDING.pop(message.peer_id)]
+        if message.unprocessed_messages and PERSIST_PENDING:
+            await db_api.run(db_api.delete_pending, message.peer_id)
+        menu = message.payload[-1].get('mid', 'no_menu')
 
     elif message.text == 'restart':
-        menu = getattr(system.Functions(), 'main')
+        menu = 'main'
 
     else:
-        TMP_MESSAGES.setdefault(message.peer_id, list()).append(message)
+        pending = PENDING.add(message.peer_id, message.message_id, message.text, message.attachments)
+        if PERSIST_PENDING:
+            await db_api.run(db_api.save_pending, message.peer_id, pending, PENDING.per_peer)
         menu = None
 
     timer(timers, 'get_menu')
     if menu:
-        bot_message = await menu(message)
+        bot_message = await system.dispatch(menu, message)
         timer(timers, 'process_menu')
         await msg_read
         timer(timers, 'read_message')
-        print(f'msg_to_send: {bot_message.convert_to_vk()}')
-        a = bot_message.convert_to_vk()
-        send_message = await vk.msg_send(bot_message.convert_to_vk())
+        vk_message = bot_message.convert_to_vk()
+        logging.debug(f'msg to send: {vk_message}')
+        send_message = await vk.msg_send(vk_message)
         timer(timers, 'send_message')
-        logging.info(f'msg send: {send_message}')
+        save_navigation = asyncio.create_task(system.save_navigation())
+        BACKGROUND_TASKS.add(save_navigation)
+        save_navigation.add_done_callback(BACKGROUND_TASKS.discard)
         recieve_time = time.time() - message.recieve_time
-        print(f'msg send: {send_message}, time: {round(recieve_time, 3)}s.')
+        logging.info(f'msg send: {send_message}, time: {round(recieve_time, 3)}s.')
         if send_message:
             STATS['msg_send'] += 1
-            STATS['msg_send_time'] = [recieve_time] + STATS['msg_send_time'][:999]
+            LATENCY.record(recieve_time)
 
     else:
         await msg_read
         timer(timers, 'read_message')
-    print(timers)
+    record_timers(timers, menu)
 
 
 @routes.post('/vk_callback/')
@@ -108,29 +152,140 @@ async def vk_callback(request):
             confirm = CONF.get('VK', 'confirm', fallback='')
             return web.Response(text=confirm)
 
-        elif request_json.get('type') == 'message_new':
+        # vk repeats the delivery when we answer too slowly
+        event_id = request_json.get('event_id')
+        if event_id and EVENTS.seen(event_id):
+            return web.Response(text="Ok")
+        if event_id and PERSIST_EVENTS:
+            from database import db_api
+            save_event = asyncio.create_task(db_api.run(db_api.save_event, event_id))
+            BACKGROUND_TASKS.add(save_event)
+            save_event.add_done_callback(BACKGROUND_TASKS.discard)
+
+        if request_json.get('type') == 'message_new':
             STATS['msg_get'] += 1
             new_message = request_json.get('object').get('message')
-            asyncio.create_task(vk_analyze(new_message))
+            WORKERS.submit(new_message['peer_id'], new_message)
     return web.Response(text="Ok")
 
 
+async def process_message(params):
+    # all vk calls made while answering share the reply deadline
+    with vk_api.deadline(REPLY_DEADLINE):
+        await vk_analyze(params)
+
+
+WORKERS = PeerWorkers(process_message,
+                      workers=CONF.getint('VK', 'workers', fallback=8),
+                      max_queue=CONF.getint('VK', 'queue_size', fallback=1000),
+                      shed_policy=CONF.get('VK', 'shed_policy', fallback='reject'),
+                      max_wait=CONF.getint('VK', 'queue_max_wait', fallback=60))
+
+
+async def prune_events():
+    # saved event ids are only needed while vk may repeat the delivery
+    from database import db_api
+    while True:
+        await asyncio.sleep(PRUNE_INTERVAL)
+        try:
+            deleted = await db_api.run(db_api.prune_events, time.time() - EVENTS.ttl)
+            logging.debug(f'events deleted: {deleted}')
+        except Exception as error_msg:
+            logging.exception(f'prune events: {error_msg}')
+
+
+async def prune_pending():
+    # the in-memory caps are applied to the saved messages too
+    from database import db_api
+    while True:
+        await asyncio.sleep(PRUNE_INTERVAL)
+        try:
+            deleted = await db_api.run(db_api.prune_pending, time.time() - PENDING.ttl, PENDING.max_messages)
+            logging.debug(f'pending messages deleted: {deleted}')
+        except Exception as error_msg:
+            logging.exception(f'prune pending: {error_msg}')
+
+
+async def on_startup(app):
+    from database import db_api
+    if PERSIST_EVENTS:
+        EVENTS.load(await db_api.run(db_api.load_events, time.time() - EVENTS.ttl))
+    if PERSIST_PENDING:
+        PENDING.load(await db_api.run(db_api.load_pending, time.time() - PENDING.ttl, PENDING.max_messages))
+    await db_api.run(db_api.clear_upload_cache)
+    WORKERS.start()
+    await vk.start()
+    if system.vk is not vk:
+        # bot_menu.system imports its own copy of this module when it runs as a script
+        await system.vk.start(vk.session)
+    JOBS.append(asyncio.create_task(system.post_arts()))
+    JOBS.append(asyncio.create_task(system.inactive_notification()))
+    JOBS.append(asyncio.create_task(system.clear_navigation()))
+    if PERSIST_EVENTS:
+        JOBS.append(asyncio.create_task(prune_events()))
+    if PERSIST_PENDING:
+        JOBS.append(asyncio.create_task(prune_pending()))
+
+
+async def on_cleanup(app):
+    for job in JOBS:
+        job.cancel()
+    await asyncio.gather(*JOBS, return_exceptions=True)
+    JOBS.clear()
+    await system.STAGER.stop()
+    await WORKERS.stop()
+    await system.vk.close()
+    await vk.close()
+
+
+@routes.get('/metrics')
+async def metrics_page(request):
+    queue = WORKERS.stats()
+    metrics.QUEUE_SIZE.set(queue['queued'])
+    metrics.QUEUE_BUSY.set(queue['busy'])
+    uploads = vk_api.UPLOADS.stats()
+    for state in ('queued', 'active'):
+        metrics.UPLOADS.set(uploads[state], state=state)
+    return web.Response(body=metrics.render().encode('utf-8'),
+                        headers={'Content-Type': 'application/openmetrics-text; version=1.0.0; charset=utf-8'})
+
+
 @routes.get('/')
 async def index(request):
     uptime_days = int(time.time() - STATS['start_time']) // (24 * 60 * 60)
     uptime = time.strftime('%X', time.gmtime(time.time() - STATS['start_time']))
-    msg_time = STATS['msg_send_time']
-    mean_5 = sum(msg_time[:5])/len(msg_time[:5]) if msg_time[:5] else 0
-    mean_25 = sum(msg_time[:25])/len(msg_time[:25]) if msg_time[:25] else 0
-    mean_100 = sum(msg_time[:100])/len(msg_time[:100]) if msg_time[:100] else 0
+    latency = ''
+    for window, title in LATENCY_WINDOWS:
+        p = LATENCY.percentiles(window)
+        latency += f" - last {title}: p50 {round(p['p50'], 3)} s., p90 {round(p['p90'], 3)} s., " \
+                   f"p99 {round(p['p99'], 3)} s., max {round(p['max'], 3)} s. ({p['count']} messages)\n"
+    queue = WORKERS.stats()
+    uploads = vk_api.UPLOADS.stats()
+    pending = PENDING.stats()
+    render = system.RENDER_CACHE.stats()
+    menus = sorted(system.ROUTES.values(), key=lambda r: r.total_time, reverse=True)
+    menu_stats = ''.join(f" - {r.mid}: {r.calls} calls, mean {round(r.stats()['mean_time'], 3)} s., "
+                         f"max {round(r.max_time, 3)} s., timeouts {r.timeouts}, errors {r.errors}\n"
+                         for r in menus if r.calls)
 
     return web.Response(text=f"server uptime: {uptime_days} days and {uptime}\n"
                              f"messages get: {STATS['msg_get']}\n"
                              f"messages send: {STATS['msg_send']}\n"
-                             f"mean time: \n"
-                             f" - last 5:   {round(mean_5, 3)} s.\n"
-                             f" - last 25:  {round(mean_25, 3)} s.\n"
-                             f" - last 100: {round(mean_100, 3)} s.\n")
+                             f"response time:\n{latency}"
+                             f"queue: {queue['queued']} messages from {queue['peers']} chats "
+                             f"(max {queue['max_queued']}), {queue['busy']} in work\n"
+                             f"dropped: {queue['dropped']}, expired: {queue['expired']}, "
+                             f"failed: {queue['failed']}\n"
+                             f"uploads: {uploads['active']} in work, {uploads['queued']} waiting, "
+                             f"{uploads['done']} done, {uploads['failed']} failed, "
+                             f"{uploads['cancelled']} cancelled, "
+                             f"{round(uploads['downloaded'] / 2 ** 20, 1)} MB downloaded\n"
+                             f"pending: {pending['messages']} messages from {pending['peers']} chats, "
+                             f"evicted: {pending['evicted']}\n"
+                             f"render cache: {render['size']} entries, {render['hits']} hits, "
+                             f"{render['misses']} misses\n"
+                             f"duplicate events: {EVENTS.duplicates}\n"
+                             f"menus:\n{menu_stats}")
 
 
 if __name__ == '__main__':
@@ -142,15 +297,14 @@ if __name__ == '__main__':
     done, _ = ioloop.run_until_complete(asyncio.wait(tasks))
     admins = list(done)[0].result()
     db_api.update_admins(admins)
-    ioloop.create_task(system.post_arts())
-    ioloop.create_task(system.inactive_notification())
 
     STATS = {
         'start_time': time.time(),
         'msg_get': 0,
         'msg_send': 0,
-        'msg_send_time': list()
      }
     app = web.Application()
     app.add_routes(routes)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
     web.run_app(app, port=5000)
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# main reads bot_settings.inf and writes log/ relative to the working directory,
+# the tests run in an empty one
+os.chdir(tempfile.mkdtemp())
+os.mkdir('log')
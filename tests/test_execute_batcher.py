@@ -0,0 +1,108 @@
+import asyncio
+import json
+import re
+from api import vk_api
+
+
+class FakeApi:
+    # answers execute with the parameters of every sub-call, or with `answer` when given
+    def __init__(self, answer=None):
+        self.answer = answer
+        self.calls = []
+
+    async def request_get(self, method, parameters=None, priority=vk_api.PRIORITY_DEFAULT, retries=True):
+        assert not retries
+        self.calls.append((method, parameters, priority))
+        if self.answer is not None:
+            return self.answer
+        if method != 'execute':
+            return {'response': parameters}
+        return {'response': [json.loads(p) for p in re.findall(r'API\.[\w.]+\((\{.*?\})\)', parameters['code'])]}
+
+
+def run_calls(api, calls, window=0.01):
+    async def main():
+        batcher = vk_api.ExecuteBatcher(api, window)
+        return await asyncio.gather(*[batcher.call(method, params, priority) for method, params, priority in calls])
+    return asyncio.run(main())
+
+
+def test_single_call_is_sent_directly():
+    api = FakeApi()
+    results = run_calls(api, [('users.get', {'user_ids': 1, 'access_token': 'x', 'v': '5.103'}, 1)])
+    assert results == [{'response': {'user_ids': 1}}]
+    assert api.calls == [('users.get', {'user_ids': 1}, 1)]
+
+
+def test_results_fan_out_in_order():
+    api = FakeApi()
+    results = run_calls(api, [('users.get', {'n': n}, 1) for n in range(5)])
+    assert results == [{'response': {'n': n}} for n in range(5)]
+    assert len(api.calls) == 1
+    assert api.calls[0][0] == 'execute'
+
+
+def test_priority_is_the_highest_of_the_batch():
+    api = FakeApi()
+    run_calls(api, [('users.get', {'n': 0}, vk_api.PRIORITY_BACKGROUND),
+                    ('users.get', {'n': 1}, vk_api.PRIORITY_INTERACTIVE)])
+    assert api.calls[0][2] == vk_api.PRIORITY_INTERACTIVE
+
+
+def test_false_results_take_execute_errors_in_order():
+    errors = [{'error_code': 15, 'method': 'a'}, {'error_code': 18, 'method': 'c'}]
+    api = FakeApi({'response': [False, {'ok': 1}, False, 5], 'execute_errors': errors})
+    results = run_calls(api, [(m, {}, 1) for m in ('a', 'b', 'c', 'd')])
+    assert results == [{'error': errors[0]}, {'response': {'ok': 1}}, {'error': errors[1]}, {'response': 5}]
+
+
+def test_missing_results_and_errors():
+    api = FakeApi({'response': [False]})
+    results = run_calls(api, [('a', {}, 1), ('b', {}, 1)])
+    assert results[0]['error']['error_code'] == 0
+    assert results[1]['error']['error_msg'] == 'no execute result for b'
+
+
+def test_failed_execute_goes_to_every_caller():
+    error = {'error': {'error_code': 6, 'error_msg': 'Too many requests per second'}}
+    api = FakeApi(error)
+    assert run_calls(api, [('a', {}, 1), ('b', {}, 1)]) == [error, error]
+
+
+def test_more_than_max_calls_are_split():
+    count = vk_api.ExecuteBatcher.MAX_CALLS + 5
+    api = FakeApi()
+    results = run_calls(api, [('users.get', {'n': n}, 1) for n in range(count)])
+    assert results == [{'response': {'n': n}} for n in range(count)]
+    assert [len(re.findall(r'API\.', call[1]['code'])) for call in api.calls] == [vk_api.ExecuteBatcher.MAX_CALLS, 5]
+
+
+class FakeLimiter:
+    def __init__(self):
+        self.throttled = 0
+
+    def throttle(self):
+        self.throttled += 1
+
+
+def test_too_many_requests_in_execute_throttles():
+    api = FakeApi({'response': [False, 1], 'execute_errors': [{'error_code': 6}]})
+    api.limiter = FakeLimiter()
+    run_calls(api, [('a', {}, 1), ('b', {}, 1)])
+    assert api.limiter.throttled == 1
+
+
+def test_batched_call_is_retried_once_per_attempt():
+    api = vk_api.VkApi('token', '5.103', retry_policy=vk_api.RetryPolicy(max_attempts=3, base_delay=0.001))
+    sent = []
+
+    async def request_once(method, parameters, session, priority):
+        sent.append(method)
+        result = {'error': {'error_code': 10}}
+        return result, api.retry_policy.need_retry(result), None
+    api.request_once = request_once
+
+    async def main():
+        return await api.request_get('users.get', {'user_ids': 1}, batch=True)
+    assert asyncio.run(main()) == {'error': {'error_code': 10}}
+    assert sent == ['users.get'] * 3
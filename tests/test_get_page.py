@@ -0,0 +1,68 @@
+import peewee
+import pytest
+# main.py imports bot_menu.system before the database, keep that order
+from bot_menu import system  # noqa: F401
+from database import db_api
+
+items_db = peewee.SqliteDatabase(':memory:')
+
+
+class Item(peewee.Model):
+    id = peewee.IntegerField(primary_key=True)
+    score = peewee.IntegerField()
+
+    class Meta:
+        database = items_db
+
+
+@pytest.fixture
+def items():
+    # scores repeat, so the id has to break the ties
+    items_db.create_tables([Item])
+    Item.insert_many([(n, n % 4) for n in range(1, 24)], fields=[Item.id, Item.score]).execute()
+    yield
+    items_db.drop_tables([Item])
+
+
+def walk(keys, desc=False, limit=5):
+    pages, after = [], None
+    while True:
+        rows, prev_page, next_page = db_api.get_page(Item.select(), keys, after=after, limit=limit, desc=desc)
+        pages.append([row.id for row in rows])
+        assert (prev_page is None) == (after is None)
+        if not next_page:
+            break
+        after = next_page
+    back = []
+    while prev_page:
+        rows, prev_page, next_page = db_api.get_page(Item.select(), keys, before=prev_page, limit=limit, desc=desc)
+        assert next_page is not None
+        back.append([row.id for row in rows])
+    return pages, back[::-1]
+
+
+def test_pages_follow_the_order(items):
+    pages, back = walk((Item.score, Item.id))
+    expected = [item.id for item in sorted(Item.select(), key=lambda i: (i.score, i.id))]
+    assert sum(pages, []) == expected
+    assert all(len(page) == 5 for page in pages[:-1])
+    assert back == pages[:-1]
+
+
+def test_descending_pages(items):
+    pages, back = walk((Item.score, Item.id), desc=True)
+    expected = [item.id for item in sorted(Item.select(), key=lambda i: (-i.score, -i.id))]
+    assert sum(pages, []) == expected
+    assert back == pages[:-1]
+
+
+def test_full_last_page_has_no_next(items):
+    rows, prev_page, next_page = db_api.get_page(Item.select(), (Item.id,), after=[3], limit=20)
+    assert [row.id for row in rows] == list(range(4, 24))
+    assert prev_page == [4]
+    assert next_page is None
+
+
+def test_empty_page(items):
+    assert db_api.get_page(Item.select().where(Item.id < 0), (Item.id,)) == ([], None, None)
+    assert db_api.get_page(Item.select(), (Item.id,), after=[100]) == ([], None, None)
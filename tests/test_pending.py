@@ -0,0 +1,66 @@
+import time
+from utils.pending import PendingMessages, compact_attachments
+
+
+def wall_post(post_id):
+    return {'type': 'wall', 'wall': {
+        'id': post_id, 'owner_id': -1, 'from_id': -1, 'date': 1, 'text': 'long text',
+        'from': {'id': 1, 'name': 'group', 'type': 'page', 'is_closed': 0, 'photo_50': 'url'},
+        'likes': {'count': 3, 'user_likes': 0},
+        'attachments': [
+            {'type': 'photo', 'photo': {'id': 1, 'sizes': [{'type': 'x', 'width': 10, 'height': 20, 'url': 'u'}]}},
+            {'type': 'link', 'link': {'url': 'l'}},
+        ],
+    }}
+
+
+def test_compact_keeps_only_wall_posts():
+    attachments = [{'type': 'photo', 'photo': {}}, wall_post(5)]
+    assert compact_attachments(attachments) == [{'type': 'wall', 'wall': {
+        'id': 5, 'from_id': -1, 'owner_id': -1, 'date': 1,
+        'from': {'id': 1, 'name': 'group', 'type': 'page', 'is_closed': 0},
+        'likes': {'count': 3},
+        'attachments': [{'type': 'photo', 'photo': {'sizes': [{'width': 10, 'height': 20, 'url': 'u'}]}}],
+    }}]
+
+
+def test_per_peer_cap_keeps_the_newest():
+    pending = PendingMessages(per_peer=3)
+    for n in range(5):
+        pending.add(1, n)
+    assert [m['message_id'] for m in pending.pop(1)] == [2, 3, 4]
+    assert pending.stats() == {'messages': 0, 'peers': 0, 'evicted': 2}
+
+
+def test_global_cap_evicts_the_stalest_peer_first():
+    pending = PendingMessages(per_peer=10, max_messages=4)
+    now = time.time()
+    pending.add(1, 10, add_time=now)
+    pending.add(1, 11, add_time=now + 1)
+    pending.add(2, 20, add_time=now + 2)
+    pending.add(1, 12, add_time=now + 3)
+    pending.add(3, 30, add_time=now + 4)
+    # peer 1 wrote last after peer 2, so peer 2 is the stalest
+    assert pending.stats()['messages'] == 4
+    assert pending.pop(2) == []
+    assert [m['message_id'] for m in pending.pop(1)] == [10, 11, 12]
+
+
+def test_expired_messages_are_dropped():
+    pending = PendingMessages(ttl=60)
+    pending.add(1, 1, add_time=time.time() - 120)
+    pending.add(2, 2)
+    assert pending.pop(1) == []
+    assert [m['message_id'] for m in pending.pop(2)] == [2]
+    assert pending.stats()['evicted'] == 1
+
+
+def test_load_restores_in_time_order():
+    pending = PendingMessages()
+    now = time.time()
+    records = [(1, now - 1, {'message_id': 2, 'text': '', 'attachments': []}),
+               (1, now - 2, {'message_id': 1, 'text': 'a', 'attachments': [wall_post(1)]})]
+    pending.load(records)
+    messages = pending.pop(1)
+    assert [m['message_id'] for m in messages] == [1, 2]
+    assert messages[0]['attachments'][0]['wall']['id'] == 1
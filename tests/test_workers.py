@@ -0,0 +1,97 @@
+import asyncio
+import time
+from utils.workers import PeerWorkers, SHED_BUSIEST
+
+
+def run_workers(items, workers=2, handler=None, **kwargs):
+    # submits (peer_id, item) pairs before starting and waits until all are handled
+    handled = []
+    active = set()
+
+    async def default_handler(item):
+        peer_id = item[0]
+        assert peer_id not in active
+        active.add(peer_id)
+        await asyncio.sleep(0.001)
+        active.discard(peer_id)
+        handled.append(item)
+
+    async def main():
+        pool = PeerWorkers(handler or default_handler, workers=workers, **kwargs)
+        for peer_id, item in items:
+            pool.submit(peer_id, (peer_id, item))
+        pool.start()
+        while pool.size or pool.busy:
+            await asyncio.sleep(0.001)
+        await pool.stop()
+        return pool
+    return asyncio.run(main()), handled
+
+
+def test_peer_order_is_kept():
+    items = [(peer_id, n) for n in range(5) for peer_id in (1, 2, 3)]
+    pool, handled = run_workers(items, workers=3)
+    for peer_id in (1, 2, 3):
+        assert [n for p, n in handled if p == peer_id] == list(range(5))
+    assert pool.stats()['processed'] == 15
+
+
+def test_peers_take_turns():
+    items = [(1, n) for n in range(5)] + [(2, 0)]
+    pool, handled = run_workers(items, workers=1)
+    assert handled.index((2, 0)) == 1
+
+
+def test_full_queue_rejects():
+    pool = PeerWorkers(None, max_queue=2)
+    assert pool.submit(1, 'a') and pool.submit(2, 'b')
+    assert not pool.submit(3, 'c')
+    assert pool.stats()['dropped'] == 1
+    assert pool.size == 2
+
+
+def test_busiest_peer_is_shed():
+    pool = PeerWorkers(None, max_queue=3, shed_policy=SHED_BUSIEST)
+    for item in ('a', 'b', 'c'):
+        pool.submit(1, item)
+    assert pool.submit(2, 'd')
+    assert [item for _, item in pool.pending[1]] == ['b', 'c']
+    assert pool.size == 3
+    assert pool.stats()['dropped'] == 1
+
+
+def test_stale_messages_expire():
+    async def handler(item):
+        raise AssertionError('expired message handled')
+
+    async def main():
+        pool = PeerWorkers(handler, max_wait=1)
+        pool.submit(1, 'a')
+        pool.pending[1][0] = (time.time() - 2, 'a')
+        pool.start()
+        while pool.size:
+            await asyncio.sleep(0.001)
+        await pool.stop()
+        return pool
+    assert asyncio.run(main()).stats()['expired'] == 1
+
+
+def test_failed_message_does_not_stop_the_peer():
+    handled = []
+
+    async def handler(item):
+        if item == 'a':
+            raise ValueError(item)
+        handled.append(item)
+
+    async def main():
+        pool = PeerWorkers(handler, workers=1)
+        pool.submit(1, 'a')
+        pool.submit(1, 'b')
+        pool.start()
+        while pool.size or pool.busy:
+            await asyncio.sleep(0.001)
+        await pool.stop()
+        return pool
+    assert asyncio.run(main()).stats()['failed'] == 1
+    assert handled == ['b']
@@ -0,0 +1,35 @@
+import collections
+import time
+
+
+class EventCache:
+    # remembers recently seen callback event ids, oldest are evicted first
+    def __init__(self, max_size=10000, ttl=60 * 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.events = collections.OrderedDict()
+        self.duplicates = 0
+
+    def expire(self):
+        min_time = time.time() - self.ttl
+        while self.events:
+            event_id, add_time = next(iter(self.events.items()))
+            if add_time > min_time and len(self.events) <= self.max_size:
+                break
+            self.events.popitem(last=False)
+
+    def add(self, event_id, add_time=None):
+        self.events[event_id] = add_time if add_time else time.time()
+
+    def seen(self, event_id):
+        self.expire()
+        if event_id in self.events:
+            self.duplicates += 1
+            return True
+        self.add(event_id)
+        return False
+
+    def load(self, events):
+        for event_id, add_time in sorted(events, key=lambda e: e[1]):
+            self.add(event_id, add_time)
+        self.expire()
@@ -0,0 +1,74 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+
+FILE_FORMAT = '%(filename)-25s[LINE:%(lineno)4d]# %(levelname)-8s [%(asctime)s]  %(message)s'
+CONSOLE_FORMAT = '%(name)-15s: %(levelname)-8s %(message)s'
+DATE_FORMAT = '%m-%d %H:%M'
+LISTENER = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'logger': record.name,
+            'file': record.filename,
+            'line': record.lineno,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class DebugSampler(logging.Filter):
+    # passes only a share of DEBUG records, other levels always pass
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or random.random() < self.rate
+
+
+def setup(filename, level=logging.DEBUG, console_level=logging.INFO, json_format=True,
+          max_bytes=10 * 2 ** 20, backup_count=5, debug_sample=1.0):
+    # records are only put in a queue on the calling thread,
+    # formatting and writing happen on the listener thread
+    global LISTENER
+    if LISTENER:
+        return
+    file_handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes,
+                                                        backupCount=backup_count, encoding='utf-8')
+    if json_format:
+        file_handler.setFormatter(JsonFormatter(datefmt='%Y-%m-%dT%H:%M:%S'))
+    else:
+        file_handler.setFormatter(logging.Formatter(FILE_FORMAT, datefmt=DATE_FORMAT))
+    console = logging.StreamHandler()
+    console.setLevel(console_level)
+    console.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(DebugSampler(debug_sample))
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    LISTENER = logging.handlers.QueueListener(log_queue, file_handler, console, respect_handler_level=True)
+    LISTENER.start()
+    atexit.register(stop)
+
+
+def stop():
+    global LISTENER
+    if LISTENER:
+        LISTENER.stop()
+        LISTENER = None
@@ -0,0 +1,147 @@
+import array
+import bisect
+import threading
+import time
+
+REGISTRY = list()
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class LatencyWindow:
+    # fixed-size ring of (time, latency) samples, recording never allocates.
+    # percentiles are computed on demand over the samples of a time window
+    def __init__(self, size=4096):
+        self.size = size
+        self.values = array.array('d', [0.0] * size)
+        self.times = array.array('d', [0.0] * size)
+        self.pos = 0
+        self.count = 0
+
+    def record(self, value, now=None):
+        self.values[self.pos] = value
+        self.times[self.pos] = now if now is not None else time.time()
+        self.pos = (self.pos + 1) % self.size
+        self.count += 1
+
+    def samples(self, window=None, now=None):
+        filled = min(self.count, self.size)
+        if window is None:
+            return list(self.values[:filled])
+        min_time = (now if now is not None else time.time()) - window
+        return [self.values[i] for i in range(filled) if self.times[i] >= min_time]
+
+    def percentiles(self, window=None, quantiles=(50, 90, 99), now=None):
+        values = sorted(self.samples(window, now))
+        stats = {'count': len(values), 'max': values[-1] if values else 0}
+        for q in quantiles:
+            # nearest rank
+            rank = max(0, -(-len(values) * q // 100) - 1)
+            stats[f'p{q}'] = values[rank] if values else 0
+        return stats
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = 'unknown'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = dict()
+        # the DB pool threads record too
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def samples(self):
+        return []
+
+    def render(self):
+        lines = [f'# TYPE {self.name} {self.kind}', f'# HELP {self.name} {self.documentation}']
+        for suffix, key, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{format_labels(self.labels, key, extra)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        return [('_total', key, (), value) for key, value in sorted(self.values.items())]
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def samples(self):
+        return [('', key, (), value) for key, value in sorted(self.values.items())]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values:
+                # per bucket counts, the last one is +Inf, then sum
+                self.values[key] = [array.array('q', [0] * (len(self.buckets) + 1)), 0.0]
+            counts = self.values[key]
+            counts[0][bisect.bisect_left(self.buckets, value)] += 1
+            counts[1] += value
+
+    def samples(self):
+        samples = list()
+        with self.lock:
+            values = [(key, (counts[:], total)) for key, (counts, total) in self.values.items()]
+        for key, (counts, total) in sorted(values):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                samples.append(('_bucket', key, (('le', bound),), cumulative))
+            samples.append(('_count', key, (), cumulative))
+            samples.append(('_sum', key, (), total))
+        return samples
+
+
+def render():
+    # OpenMetrics text exposition of every registered metric
+    return ''.join(metric.render() for metric in REGISTRY) + '# EOF\n'
+
+
+STAGE_TIME = Histogram('bot_stage_seconds', 'Time spent in each stage of a message handling',
+                       ('stage', 'mid'))
+VK_CALLS = Counter('bot_vk_calls', 'VK API calls by method and error code, 0 is success, -1 is no answer',
+                   ('method', 'error'))
+DB_QUERIES = Histogram('bot_db_query_seconds', 'SQL statements by kind', ('statement',),
+                       buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1))
+QUEUE_SIZE = Gauge('bot_queue_messages', 'Messages waiting in the incoming queue')
+QUEUE_BUSY = Gauge('bot_queue_busy_workers', 'Workers handling a message right now')
+UPLOADS = Gauge('bot_uploads', 'Image uploads by state', ('state',))
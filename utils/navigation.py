@@ -0,0 +1,66 @@
+import base64
+import collections
+import hashlib
+import json
+import threading
+import time
+
+
+def state_id(data):
+    return base64.urlsafe_b64encode(hashlib.blake2b(data.encode('utf-8'), digest_size=9).digest()).decode()
+
+
+class NavigationStore:
+    # menu breadcrumbs are kept here, buttons only carry a short state id.
+    # the id is a hash of the stack, so a repeated stack gets the same id.
+    # a state in use is written to the database again every `refresh` seconds to keep it from expiring
+    def __init__(self, max_size=50000, max_depth=20, refresh=24 * 60 * 60):
+        self.max_size = max_size
+        self.max_depth = max_depth
+        self.refresh = refresh
+        # state id -> (stack json, when it was last marked for saving)
+        self.states = collections.OrderedDict()
+        self.unsaved = dict()
+        self.lock = threading.Lock()
+
+    def put(self, stack):
+        data = json.dumps(stack[-self.max_depth:], ensure_ascii=False, separators=(',', ':'))
+        sid = state_id(data)
+        with self.lock:
+            self.touch(sid, data)
+        return sid
+
+    def touch(self, sid, data):
+        state = self.states.get(sid)
+        now = time.time()
+        if state is None or state[1] < now - self.refresh:
+            self.unsaved[sid] = data
+            self.add(sid, data, now)
+        else:
+            self.states.move_to_end(sid)
+
+    def add(self, sid, data, saved):
+        self.states[sid] = (data, saved)
+        self.states.move_to_end(sid)
+        while len(self.states) > self.max_size:
+            self.states.popitem(last=False)
+
+    def get(self, sid):
+        with self.lock:
+            state = self.states.get(sid)
+            if state is None:
+                return None
+            self.touch(sid, state[0])
+        return json.loads(state[0])
+
+    def load(self, sid, data):
+        # a state read back from the database, it is in use again
+        with self.lock:
+            self.touch(sid, data)
+        return json.loads(data)
+
+    def flush(self):
+        # states created or reused since the last call, to be written to the database
+        with self.lock:
+            unsaved, self.unsaved = self.unsaved, dict()
+        return list(unsaved.items())
@@ -0,0 +1,87 @@
+import collections
+import time
+
+POST_FIELDS = ('id', 'from_id', 'to_id', 'owner_id', 'date')
+FROM_FIELDS = ('id', 'name', 'type', 'is_closed')
+SIZE_FIELDS = ('width', 'height', 'url')
+
+
+def compact_attachments(attachments):
+    # keeps only the wall post fields save_group and verify_image read
+    compact = list()
+    for attachment in attachments:
+        if attachment.get('type') != 'wall':
+            continue
+        wall = attachment['wall']
+        post = {k: wall[k] for k in POST_FIELDS if k in wall}
+        if 'from' in wall:
+            post['from'] = {k: wall['from'][k] for k in FROM_FIELDS if k in wall['from']}
+        for counter in ('likes', 'views'):
+            if counter in wall:
+                post[counter] = {'count': wall[counter].get('count', 0)}
+        post['attachments'] = [
+            {'type': 'photo', 'photo': {'sizes': [{k: s[k] for k in SIZE_FIELDS} for s in a['photo']['sizes']]}}
+            for a in wall.get('attachments', []) if a['type'] == 'photo'
+        ]
+        compact.append({'type': 'wall', 'wall': post})
+    return compact
+
+
+class PendingMessages:
+    # messages sent without a button, kept until the user presses one.
+    # peers are ordered by their last message, the stalest are evicted first
+    def __init__(self, per_peer=20, max_messages=5000, ttl=60 * 60):
+        self.per_peer = per_peer
+        self.max_messages = max_messages
+        self.ttl = ttl
+        self.peers = collections.OrderedDict()
+        self.size = 0
+        self.evicted = 0
+
+    def expire(self, now=None):
+        min_time = (now if now is not None else time.time()) - self.ttl
+        while self.peers:
+            peer_id, messages = next(iter(self.peers.items()))
+            if messages[-1][0] > min_time and self.size <= self.max_messages:
+                break
+            if messages[-1][0] > min_time:
+                # over the global cap, trim the stalest peer message by message
+                messages.popleft()
+                self.size -= 1
+                self.evicted += 1
+                if messages:
+                    continue
+            else:
+                self.size -= len(messages)
+                self.evicted += len(messages)
+            del self.peers[peer_id]
+
+    def add(self, peer_id, message_id, text='', attachments=(), add_time=None):
+        record = {'message_id': message_id, 'text': text, 'attachments': compact_attachments(attachments)}
+        add_time = add_time if add_time else time.time()
+        if peer_id not in self.peers:
+            self.peers[peer_id] = collections.deque()
+        self.peers.move_to_end(peer_id)
+        messages = self.peers[peer_id]
+        messages.append((add_time, record))
+        self.size += 1
+        if len(messages) > self.per_peer:
+            messages.popleft()
+            self.size -= 1
+            self.evicted += 1
+        self.expire()
+        return record
+
+    def pop(self, peer_id):
+        self.expire()
+        messages = self.peers.pop(peer_id, ())
+        self.size -= len(messages)
+        min_time = time.time() - self.ttl
+        return [record for add_time, record in messages if add_time > min_time]
+
+    def load(self, messages):
+        for peer_id, add_time, record in sorted(messages, key=lambda m: m[1]):
+            self.add(peer_id, record['message_id'], record['text'], record['attachments'], add_time)
+
+    def stats(self):
+        return {'messages': self.size, 'peers': len(self.peers), 'evicted': self.evicted}
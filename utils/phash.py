@@ -0,0 +1,97 @@
+import io
+import logging
+import threading
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+HASH_SIZE = 8
+
+
+def dhash(image):
+    # difference hash: compares neighbour pixels of a tiny grayscale copy,
+    # survives rescaling and recompression of the same picture
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(image)) as picture:
+            picture.draft('L', (HASH_SIZE * 4, HASH_SIZE * 4))
+            pixels = list(picture.convert('L').resize((HASH_SIZE + 1, HASH_SIZE)).getdata())
+    except Exception as error_msg:
+        logging.error(f'image hash: {error_msg!r}')
+        return None
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            right = pixels[row * (HASH_SIZE + 1) + col + 1]
+            value = value << 1 | (left > right)
+    return value
+
+
+def to_hex(value):
+    return f'{value:016x}'
+
+
+def from_hex(value):
+    return int(value, 16)
+
+
+def distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class HashIndex:
+    # BK-tree over image hashes, finds every hash within a Hamming distance
+    # without comparing against the whole collection
+    def __init__(self):
+        self.root = None
+        self.size = 0
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def load(self, items):
+        with self.lock:
+            if self.loaded:
+                return
+            for value, item in items:
+                self.insert(value, item)
+            self.loaded = True
+
+    def add(self, value, item):
+        with self.lock:
+            self.insert(value, item)
+
+    def insert(self, value, item):
+        self.size += 1
+        if self.root is None:
+            self.root = (value, [item], dict())
+            return
+        node = self.root
+        while True:
+            node_value, items, children = node
+            dist = distance(value, node_value)
+            if dist == 0:
+                items.append(item)
+                self.size -= 1
+                return
+            if dist not in children:
+                children[dist] = (value, [item], dict())
+                return
+            node = children[dist]
+
+    def find(self, value, max_distance):
+        found = list()
+        with self.lock:
+            nodes = [self.root] if self.root else []
+            while nodes:
+                node_value, items, children = nodes.pop()
+                dist = distance(value, node_value)
+                if dist <= max_distance:
+                    found.extend((dist, item) for item in items)
+                for child_dist, child in children.items():
+                    if dist - max_distance <= child_dist <= dist + max_distance:
+                        nodes.append(child)
+        return sorted(found, key=lambda f: f[0])
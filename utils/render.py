@@ -0,0 +1,64 @@
+import collections
+import threading
+import time
+
+
+class RenderCache:
+    # LRU of rendered messages and keyboards. entries are tagged with the tables
+    # they were built from and dropped when one of those tables is written to
+    def __init__(self, max_size=10000, ttl=10 * 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.tags = dict()
+        self.versions = dict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[2] < time.time():
+                if entry is not None:
+                    self.remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def version(self, tags):
+        return tuple(self.versions.get(tag, 0) for tag in tags)
+
+    def put(self, key, value, tags=(), since=None):
+        # `since` is the version of the tags taken before rendering,
+        # a write in between means the value may already be stale
+        with self.lock:
+            if since is not None and since != self.version(tags):
+                return
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (value, tags, time.time() + self.ttl)
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.max_size:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        value, tags, expire = self.entries.pop(key)
+        for tag in tags:
+            keys = self.tags.get(tag)
+            if keys:
+                keys.discard(key)
+
+    def invalidate(self, *tags):
+        with self.lock:
+            for tag in tags:
+                self.versions[tag] = self.versions.get(tag, 0) + 1
+                for key in self.tags.pop(tag, ()):
+                    if key in self.entries:
+                        self.remove(key)
+
+    def stats(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
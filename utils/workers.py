@@ -0,0 +1,110 @@
+import asyncio
+import collections
+import logging
+import time
+
+SHED_REJECT = 'reject'
+SHED_BUSIEST = 'busiest'
+
+
+class PeerWorkers:
+    # fixed pool of worker coroutines fed from a bounded queue.
+    # messages of one peer are handled one at a time in arrival order,
+    # peers with pending messages take turns so one chat can't hold a worker.
+    # `label` names an item in the log, formatted with the peer id
+    def __init__(self, handler, workers=8, max_queue=1000, shed_policy=SHED_REJECT, max_wait=0,
+                 label='message from {}'):
+        self.handler = handler
+        self.label = label
+        self.workers = workers
+        self.max_queue = max_queue
+        self.shed_policy = shed_policy
+        self.max_wait = max_wait
+        self.pending = dict()
+        self.ready = None
+        self.tasks = []
+        self.size = 0
+        self.max_size = 0
+        self.busy = 0
+        self.processed = 0
+        self.dropped = 0
+        self.expired = 0
+        self.failed = 0
+
+    def start(self):
+        self.ready = asyncio.Queue()
+        for peer_id in self.pending:
+            self.ready.put_nowait(peer_id)
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def submit(self, peer_id, item):
+        if self.size >= self.max_queue and not self.shed():
+            self.dropped += 1
+            logging.warning(f'queue is full, drop {self.label.format(peer_id)}')
+            return False
+        if peer_id not in self.pending:
+            self.pending[peer_id] = collections.deque()
+            if self.ready:
+                self.ready.put_nowait(peer_id)
+        self.pending[peer_id].append((time.time(), item))
+        self.size += 1
+        self.max_size = max(self.max_size, self.size)
+        return True
+
+    def shed(self):
+        if self.shed_policy != SHED_BUSIEST or not self.pending:
+            return False
+        # free a place at the expense of the chat that floods us the most
+        busiest = max(self.pending.values(), key=len)
+        if not busiest:
+            return False
+        busiest.popleft()
+        self.size -= 1
+        self.dropped += 1
+        return True
+
+    async def worker(self):
+        while True:
+            peer_id = await self.ready.get()
+            queue = self.pending[peer_id]
+            if queue:
+                add_time, item = queue.popleft()
+                self.size -= 1
+                await self.process(peer_id, add_time, item)
+            if queue:
+                self.ready.put_nowait(peer_id)
+            else:
+                del self.pending[peer_id]
+
+    async def process(self, peer_id, add_time, item):
+        if self.max_wait and time.time() - add_time > self.max_wait:
+            self.expired += 1
+            logging.warning(f'{self.label.format(peer_id)} waited too long in the queue, skip it')
+            return
+        self.busy += 1
+        try:
+            await self.handler(item)
+            self.processed += 1
+        except Exception as error_msg:
+            self.failed += 1
+            logging.exception(f'{self.label.format(peer_id)} failed: {error_msg}')
+        finally:
+            self.busy -= 1
+
+    def stats(self):
+        return {
+            'queued': self.size,
+            'max_queued': self.max_size,
+            'peers': len(self.pending),
+            'busy': self.busy,
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'expired': self.expired,
+            'failed': self.failed,
+        }